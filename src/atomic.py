@@ -0,0 +1,34 @@
+import os
+import secrets
+from pathlib import Path
+
+
+def create_temporary(path: Path) -> tuple[int, str]:
+    """
+    Creates a hidden temporary file next to `path`, to rename over it once written.
+    Unlike mkstemp's, it gets the same permissions as files made with open().
+    """
+
+    flags = os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        temp_name = str(path.parent / f".{path.name}.{secrets.token_hex(4)}.tmp")
+        try:
+            return os.open(temp_name, flags, 0o666), temp_name
+        except FileExistsError:
+            continue
+
+
+def write_atomically(path: Path, data: bytes) -> None:
+    """
+    Writes to a hidden temporary file next to `path`, then renames it over `path`,
+    so other processes, or a later run after a crash, never see it half written
+    """
+
+    fd, temp_name = create_temporary(path)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_name, path)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
@@ -0,0 +1,268 @@
+import json
+import os
+import sqlite3
+import typing
+from dataclasses import dataclass
+from pathlib import Path
+
+from cache import hash_file
+from file_parser import PDFTextFinder, TextLine, TextLineIndex
+from question_splitter import (
+    SEARCH_PATTERNS,
+    LabelMatchStore,
+    PageData,
+    QuestionPlan,
+    Viewport,
+    plan_questions,
+)
+from source import SourcePDF
+
+# bump whenever the schema, or what is stored in it, changes
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    sha256 TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    page_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS questions (
+    paper_id INTEGER NOT NULL REFERENCES papers(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    number INTEGER NOT NULL,
+    first_page INTEGER NOT NULL,
+    last_page INTEGER NOT NULL,
+    pages TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (paper_id, number)
+);
+CREATE INDEX IF NOT EXISTS questions_number ON questions(number);
+"""
+
+
+@dataclass
+class IndexedPaper:
+    "The questions found in one paper, ready to be stored in a QuestionBank"
+
+    path: str  # absolute
+    sha256: str
+    mtime_ns: int
+    size: int
+    page_count: int
+    questions: dict[int, tuple[list[PageData], str]]  # pages and text
+
+
+@dataclass
+class BankQuestion:
+    "A question found by QuestionBank.query"
+
+    path: str
+    sha256: str
+    number: int
+    pages: list[PageData]
+    text: str
+
+
+def question_text(lines: typing.Iterable[TextLine], pages: list[PageData]) -> str:
+    "Text of the lines whose bottom edge is inside the viewport of a question's page"
+
+    viewports = {k.page: k.viewport for k in pages}
+    return "\n".join(
+        line.text
+        for line in lines
+        if (viewport := viewports.get(line.page))
+        and viewport.y2 <= line.y1 <= viewport.y1
+    )
+
+
+def index_paper(path: str, engine: str = "layout") -> IndexedPaper:
+    "Finds the questions of a paper, with their text. Runs in the batch pool."
+
+    stat = os.stat(path)
+    with SourcePDF(path) as source:
+        finder = PDFTextFinder(source, engine=engine)
+        try:
+            index = TextLineIndex(
+                source.sha256, engine, finder.page_count, finder.collect_all_lines()
+            )
+        finally:
+            finder.close()
+
+    labels = LabelMatchStore(**index.find_all_matches(SEARCH_PATTERNS))
+    if not labels.question and engine != "layout":
+        return index_paper(path)
+
+    plan = plan_questions(labels, index.page_count) if labels.question else {}
+    return IndexedPaper(
+        str(Path(path).resolve()),
+        index.sha256,
+        stat.st_mtime_ns,
+        stat.st_size,
+        index.page_count,
+        {
+            question: (pages, question_text(index.lines, pages))
+            for question, pages in plan.items()
+        },
+    )
+
+
+class QuestionBank:
+    """
+    SQLite database of the questions found in many papers, with their pages,
+    viewports and text, so they can be searched and extracted without parsing the
+    papers again.
+    """
+
+    def __init__(self, path: typing.Union[str, Path]):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA foreign_keys = ON")
+
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            with self.db:
+                self.db.executescript(
+                    "DROP TABLE IF EXISTS questions; DROP TABLE IF EXISTS papers;"
+                )
+        with self.db:
+            self.db.executescript(SCHEMA)
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def is_current(self, path: str) -> bool:
+        """
+        Whether a paper is indexed, and its file hasn't changed since. A file that
+        was only touched is hashed, and kept if its contents are the same. Files
+        that can't be read aren't current, so indexing them reports why.
+        """
+
+        try:
+            stat = os.stat(path)
+            path = str(Path(path).resolve())
+            row = self.db.execute(
+                "SELECT sha256, mtime_ns, size FROM papers WHERE path = ?", (path,)
+            ).fetchone()
+
+            if not row or row[2] != stat.st_size:
+                return False
+            if row[1] == stat.st_mtime_ns:
+                return True
+            if row[0] != hash_file(path):
+                return False
+        except OSError:
+            return False
+
+        with self.db:
+            self.db.execute(
+                "UPDATE papers SET mtime_ns = ? WHERE path = ?",
+                (stat.st_mtime_ns, path),
+            )
+        return True
+
+    def add(self, paper: IndexedPaper) -> None:
+        "Stores a paper's questions, replacing any it had before"
+
+        with self.db:
+            self.db.execute("DELETE FROM papers WHERE path = ?", (paper.path,))
+            paper_id = self.db.execute(
+                "INSERT INTO papers (path, sha256, mtime_ns, size, page_count)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    paper.path,
+                    paper.sha256,
+                    paper.mtime_ns,
+                    paper.size,
+                    paper.page_count,
+                ),
+            ).lastrowid
+            self.db.executemany(
+                "INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        paper_id,
+                        position,
+                        number,
+                        pages[0].page,
+                        pages[-1].page,
+                        json.dumps(
+                            [[k.page, k.viewport.y1, k.viewport.y2] for k in pages]
+                        ),
+                        text,
+                    )
+                    for position, (number, (pages, text)) in enumerate(
+                        paper.questions.items()
+                    )
+                ),
+            )
+
+    def remove_missing(self) -> list[str]:
+        "Forgets the papers whose files no longer exist, returning their paths"
+
+        missing = [
+            path
+            for (path,) in self.db.execute("SELECT path FROM papers")
+            if not os.path.exists(path)
+        ]
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM papers WHERE path = ?", ((k,) for k in missing)
+            )
+        return missing
+
+    def query(
+        self,
+        numbers: typing.Collection[int] = (),
+        path_pattern: typing.Optional[str] = None,
+        text: typing.Optional[str] = None,
+    ) -> list[BankQuestion]:
+        """
+        Questions with any of the given numbers, in papers whose path matches a glob
+        pattern, containing some text (case insensitive). Every filter is optional.
+        """
+
+        conditions, parameters = [], []
+        if numbers:
+            conditions.append(f"number IN ({', '.join('?' * len(numbers))})")
+            parameters.extend(numbers)
+        if path_pattern:
+            conditions.append("path GLOB ?")
+            parameters.append(path_pattern)
+        if text:
+            conditions.append("instr(lower(text), lower(?)) > 0")
+            parameters.append(text)
+
+        rows = self.db.execute(
+            "SELECT path, sha256, number, pages, text"
+            " FROM questions JOIN papers ON papers.id = paper_id"
+            f" WHERE {' AND '.join(conditions) or '1'}"
+            " ORDER BY path, position",
+            parameters,
+        )
+        return [
+            BankQuestion(
+                path,
+                sha256,
+                number,
+                [
+                    PageData(page, Viewport(y1, y2))
+                    for page, y1, y2 in json.loads(pages)
+                ],
+                text,
+            )
+            for path, sha256, number, pages, text in rows
+        ]
+
+    @staticmethod
+    def plans(questions: typing.Iterable[BankQuestion]) -> list[QuestionPlan]:
+        "Groups questions into a plan per paper, to extract them from"
+
+        plans: dict[str, QuestionPlan] = {}
+        for question in questions:
+            plan = plans.setdefault(
+                question.path, QuestionPlan(question.path, question.sha256, {})
+            )
+            typing.cast(dict, plan.questions)[question.number] = question.pages
+        return list(plans.values())
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,118 @@
+import concurrent.futures
+import contextlib
+import glob
+import itertools
+import os
+import traceback
+import typing
+from dataclasses import dataclass
+from pathlib import Path
+
+import instrument
+
+
+@dataclass
+class FileResult:
+    file: str
+    error: typing.Optional[str] = None  # formatted traceback if processing failed
+    value: typing.Any = None  # what the callback returned
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def expand_inputs(inputs: typing.Iterable[str]) -> list[str]:
+    "Expands directories and glob patterns into a sorted, de-duplicated list of PDFs"
+
+    files: dict[str, None] = {}  # ordered set
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            matches = sorted(
+                str(k) for k in path.iterdir() if k.suffix.lower() == ".pdf"
+            )
+        elif glob.has_magic(item):
+            matches = sorted(glob.glob(item, recursive=True))
+        else:
+            matches = [item]
+        files.update(dict.fromkeys(matches))
+    return list(files)
+
+
+@contextlib.contextmanager
+def worker_pool(jobs: int) -> typing.Iterator[concurrent.futures.ProcessPoolExecutor]:
+    "Process pool whose workers emit their instrumentation events to this process's sink"
+
+    sink = instrument.current()
+    if isinstance(sink, instrument.SilentSink):
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            yield executor
+        return
+
+    # a worker's own pool sends its events straight to the same queue
+    forwarder = None
+    if isinstance(sink, instrument.QueueSink):
+        queue = sink.queue
+    else:
+        forwarder = instrument.QueueForwarder(sink)
+        queue = forwarder.queue
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=instrument.install_queue, initargs=(queue,)
+        ) as executor:
+            yield executor
+    finally:
+        if forwarder:
+            forwarder.close()
+
+
+def run_one(callback: typing.Callable[[str], typing.Any], file: str) -> FileResult:
+    try:
+        value = callback(file)
+    except Exception:
+        return FileResult(file, traceback.format_exc())
+    return FileResult(file, value=value)
+
+
+def process_files(
+    files: typing.Sequence[str],
+    callback: typing.Callable[[str], typing.Any],
+    jobs: typing.Optional[int] = None,
+) -> typing.Iterator[FileResult]:
+    """
+    Runs `callback` on every file across a bounded process pool, yielding a
+    FileResult per file as soon as it finishes. A failing file is reported in its
+    result and does not stop the others.
+
+    `callback` must be picklable (i.e. a module-level function or a partial of one),
+    and so must what it returns.
+    """
+
+    jobs = jobs or os.cpu_count() or 1
+
+    if jobs == 1:
+        for file in files:
+            yield run_one(callback, file)
+        return
+
+    pending_files = iter(files)
+    with worker_pool(jobs) as executor:
+
+        def _submit_next(count: int) -> set[concurrent.futures.Future[FileResult]]:
+            return {
+                executor.submit(run_one, callback, file)
+                for file in itertools.islice(pending_files, count)
+            }
+
+        # only keep a couple of files queued per worker, so huge batches don't
+        # all get pickled and queued up front
+        in_flight = _submit_next(jobs * 2)
+        while in_flight:
+            done, in_flight = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                yield future.result()
+            in_flight |= _submit_next(len(done))
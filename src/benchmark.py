@@ -0,0 +1,616 @@
+import contextlib
+import itertools
+import json
+import math
+import statistics
+import tempfile
+import threading
+import time
+import typing
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+
+import click
+import PyPDF2
+from pdfminer.layout import LTTextLineHorizontal
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+import file_parser
+import main
+import pdf_splitter
+import question_splitter
+from file_parser import LTObject, MatchLTTextLine, PDFTextFinder
+from memory import resident_memory
+from question_splitter import LabelMatchStore, PageData, Viewport
+
+# the generator draws every label in Helvetica, whose boxes pdfminer lays out
+# from size * DESCENT below the baseline, size * HEIGHT tall
+FONT = "Helvetica"
+FONT_SIZE = 10
+DESCENT = -0.207
+HEIGHT = 1.156
+
+HEADER_Y = 800
+TOP_Y = 760  # baseline of the first label on a page
+NEXT_PAGE_Y = 40
+FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+
+STAGES = ("detect", "plan", "crop", "write")
+
+
+def label_bottom(baseline: float) -> float:
+    return round(baseline + FONT_SIZE * DESCENT, 2)
+
+
+def label_top(baseline: float) -> float:
+    return round(baseline + FONT_SIZE * (DESCENT + HEIGHT), 2)
+
+
+@dataclass
+class ExamSpec:
+    """
+    Layout of a synthetic exam. Every `continued_every`th page holds no new
+    questions, only the rest of the previous one. An "End of section" label follows
+    the last question of every `section_every`th page with questions.
+    """
+
+    pages: int = 10
+    questions_per_page: int = 2
+    continued_every: int = 3  # 0 for none
+    continued_labels: bool = True  # "Question N (continued)" on those pages
+    section_every: int = 0  # 0 for none
+    filler_lines: int = 20  # lines of text per page, for glyph density
+    filler_chars: int = 80  # characters per filler line
+
+    @property
+    def name(self) -> str:
+        return (
+            f"{self.pages}p-{self.questions_per_page}q"
+            f"-c{self.continued_every}{'' if self.continued_labels else 'u'}"
+            f"-s{self.section_every}-{self.filler_lines}x{self.filler_chars}"
+        )
+
+
+def generate_exam(
+    spec: ExamSpec, path: typing.Union[str, Path]
+) -> dict[int, list[PageData]]:
+    """
+    Writes a synthetic exam with reportlab, returning the plan the splitter should
+    find in it.
+    """
+
+    # viewport of the pages a question continues onto, as default_viewport finds it
+    default_top = min(label_top(TOP_Y) + 20, label_bottom(HEADER_Y))
+    bottom = label_top(NEXT_PAGE_Y)
+
+    # spread a page's question labels evenly between the top label and the filler
+    spacing = (TOP_Y - 200) / max(1, spec.questions_per_page)
+    line_height = (TOP_Y - 100) / max(1, spec.filler_lines)
+    filler = (FILLER * math.ceil(spec.filler_chars / len(FILLER)))[: spec.filler_chars]
+
+    expected: dict[int, list[PageData]] = {}
+    current: typing.Optional[int] = None  # question continuing onto the next page
+    number = 1
+    sections = 0
+
+    c = canvas.Canvas(str(path), pagesize=A4)
+    for page in range(spec.pages):
+        c.setFont(FONT, FONT_SIZE)
+        c.drawString(55, HEADER_Y, "SPECIALIST UNIT 3")
+        labels = [HEADER_Y, NEXT_PAGE_Y]  # baselines, kept clear of filler
+
+        continued = (
+            page > 0
+            and spec.continued_every
+            and page % spec.continued_every == spec.continued_every - 1
+        )
+        if continued or not spec.questions_per_page:
+            if current is not None:
+                top = default_top
+                if spec.continued_labels:
+                    c.drawString(55, TOP_Y, f"Question {current} (continued)")
+                    labels.append(TOP_Y)
+                    top = label_bottom(TOP_Y)
+                expected[current].append(PageData(page, Viewport(top, bottom)))
+        else:
+            for idx in range(spec.questions_per_page):
+                y = TOP_Y - idx * spacing
+                c.drawString(55, y, f"Question {number}")
+                labels.append(y)
+                expected[number] = [PageData(page, Viewport(label_bottom(y), bottom))]
+                current = number
+                number += 1
+
+            sections += 1
+            if spec.section_every and sections % spec.section_every == 0:
+                c.drawString(200, 120, "End of section")
+                labels.append(120)
+                current = None
+
+        c.setFont(FONT, 6)
+        for idx in range(spec.filler_lines):
+            y = 100 + idx * line_height
+            # a filler line level with a label would be laid out as part of it
+            if all(abs(y - k) > FONT_SIZE * 1.5 for k in labels):
+                c.drawString(70, y, filler)
+
+        c.setFont(FONT, FONT_SIZE)
+        c.drawString(400, NEXT_PAGE_Y, "See next page")
+        c.showPage()
+    c.save()
+
+    return expected
+
+
+def generate_labels(spec: ExamSpec) -> LabelMatchStore:
+    """
+    The labels the splitter finds in the exam generate_exam writes for `spec`,
+    without drawing it, for planning question banks too big to generate quickly.
+    """
+
+    def label(page: int, x: float, baseline: float, result: str) -> MatchLTTextLine:
+        return MatchLTTextLine(
+            x, label_bottom(baseline), x + 100, label_top(baseline), page, result
+        )
+
+    labels = LabelMatchStore([], [], [], [], [])
+    spacing = (TOP_Y - 200) / max(1, spec.questions_per_page)
+    current: typing.Optional[int] = None
+    number = 1
+    sections = 0
+
+    for page in range(spec.pages):
+        labels.header.append(label(page, 55, HEADER_Y, "SPECIALIST"))
+
+        continued = (
+            page > 0
+            and spec.continued_every
+            and page % spec.continued_every == spec.continued_every - 1
+        )
+        if continued or not spec.questions_per_page:
+            if current is not None and spec.continued_labels:
+                labels.question_continued.append(
+                    label(page, 55, TOP_Y, f"{current} (con")
+                )
+        else:
+            for idx in range(spec.questions_per_page):
+                labels.question.append(
+                    label(page, 55, TOP_Y - idx * spacing, str(number))
+                )
+                current = number
+                number += 1
+
+            sections += 1
+            if spec.section_every and sections % spec.section_every == 0:
+                labels.end_of_section.append(label(page, 200, 120, "of"))
+                current = None
+
+        labels.next_page.append(label(page, 400, NEXT_PAGE_Y, "next"))
+
+    return labels
+
+
+def time_planning(spec: ExamSpec, repeat: int = 1) -> tuple[int, float]:
+    "Plans the labels of `spec`, returning the questions found and the fastest time"
+
+    labels = generate_labels(spec)
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        plan = question_splitter.plan_questions(labels, spec.pages)
+        best = min(best, time.perf_counter() - start)
+    return len(plan), best
+
+
+def plan_errors(
+    expected: typing.Mapping[int, list[PageData]],
+    actual: typing.Mapping[int, list[PageData]],
+    tolerance: float = 0.5,
+) -> list[str]:
+    "Differences between a plan and the expected one, with viewports within `tolerance`"
+
+    errors = [f"Question {k} is missing" for k in expected.keys() - actual.keys()]
+    errors += [f"Question {k} is unexpected" for k in actual.keys() - expected.keys()]
+    for question in sorted(expected.keys() & actual.keys()):
+        want, got = expected[question], actual[question]
+        if [k.page for k in want] != [k.page for k in got]:
+            errors.append(
+                f"Question {question} is on pages {[k.page for k in got]},"
+                f" expected {[k.page for k in want]}"
+            )
+            continue
+        for a, b in zip(want, got):
+            if not (
+                math.isclose(a.viewport.y1, b.viewport.y1, abs_tol=tolerance)
+                and math.isclose(a.viewport.y2, b.viewport.y2, abs_tol=tolerance)
+            ):
+                errors.append(
+                    f"Question {question} has {b.viewport} on page {b.page},"
+                    f" expected {a.viewport}"
+                )
+    return errors
+
+
+class PeakMemory:
+    "Samples resident memory on a thread, keeping the highest seen since `reset`"
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak: typing.Optional[int] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> "PeakMemory":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def reset(self) -> None:
+        self.peak = resident_memory()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            rss = resident_memory()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+
+@dataclass
+class StageResult:
+    seconds: float
+    peak_bytes: typing.Optional[int]
+
+
+@dataclass
+class BenchmarkResult:
+    exam: str
+    engine: str
+    crop_backend: str
+    pages: int
+    questions: int
+    stages: dict[str, StageResult] = field(default_factory=dict)
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def run_stages(
+    filename: str, engine: str, crop_backend: str, memory: PeakMemory
+) -> tuple[typing.Mapping[int, list[PageData]], dict[str, StageResult]]:
+    "Splits a file once, timing each stage. Returns the plan and the timings."
+
+    stages: dict[str, StageResult] = {}
+
+    @contextlib.contextmanager
+    def stage(name: str):
+        memory.reset()
+        start = time.perf_counter()
+        yield
+        stages[name] = StageResult(time.perf_counter() - start, memory.peak)
+
+    with stage("detect"):
+        labels, page_count = question_splitter.detect_labels(filename, engine=engine)
+    with stage("plan"):
+        plan = question_splitter.plan_questions(labels, page_count)
+
+    with open(filename, "rb") as f:
+        reader = PyPDF2.PdfFileReader(f)
+        text_page = pdf_splitter.create_textbox_in_page("Benchmark", location=(55, 790))
+        cropper = pdf_splitter.CROPPERS[crop_backend](reader, text_page)
+
+        with stage("crop"):
+            outputs = [
+                main.build_question(cropper, question, pages)
+                for question, pages in plan.items()
+            ]
+        with stage("write"):
+            for output in outputs:
+                with tempfile.TemporaryFile() as out:
+                    output.write(out)
+
+    return plan, stages
+
+
+def run_benchmark(
+    specs: typing.Iterable[ExamSpec],
+    engines: typing.Iterable[str],
+    crop_backends: typing.Iterable[str],
+    repeat: int = 1,
+) -> typing.Iterator[BenchmarkResult]:
+    """
+    Generates each exam, and splits it with every engine and crop backend. Each
+    stage keeps its fastest time and highest peak memory out of `repeat` runs.
+    """
+
+    with tempfile.TemporaryDirectory() as folder, PeakMemory() as memory:
+        for spec in specs:
+            filename = str(Path(folder) / f"{spec.name}.pdf")
+            expected = generate_exam(spec, filename)
+
+            for engine, crop_backend in itertools.product(engines, crop_backends):
+                runs = [
+                    run_stages(filename, engine, crop_backend, memory)
+                    for _ in range(repeat)
+                ]
+                result = BenchmarkResult(
+                    spec.name, engine, crop_backend, spec.pages, len(expected)
+                )
+                for name in STAGES:
+                    peaks = [k[1][name].peak_bytes for k in runs]
+                    result.stages[name] = StageResult(
+                        min(k[1][name].seconds for k in runs),
+                        None if None in peaks else max(typing.cast(list[int], peaks)),
+                    )
+                result.errors = plan_errors(expected, runs[0][0])
+                yield result
+
+
+def recursive_traverse(
+    o: LTObject,
+    regexes: typing.Mapping[str, typing.Pattern[str]],
+    collection: dict[str, list[MatchLTTextLine]],
+    page: int = 0,
+) -> dict[str, list[MatchLTTextLine]]:
+    """
+    The search PDFTextFinder.traverse_hierarchy replaced, kept to measure it
+    against. Builds and searches the text of every object in the tree, though
+    containers rebuild theirs from all their characters and only lines can match.
+    """
+
+    if hasattr(o, "get_text") and (text := o.get_text().strip()):  # type: ignore
+        for label, regex in regexes.items():
+            match = regex.search(text)
+            if isinstance(o, LTTextLineHorizontal) and match:
+                collection[label].append(MatchLTTextLine(*o.bbox, page, match.group(1)))
+
+    if isinstance(o, typing.Iterable):
+        for child in typing.cast(typing.Iterable[LTObject], o):
+            recursive_traverse(child, regexes, collection, page)
+    return collection
+
+
+TRAVERSALS: dict[str, typing.Callable[..., dict[str, list[MatchLTTextLine]]]] = {
+    "recursive": recursive_traverse,
+    "iterative": PDFTextFinder.traverse_hierarchy,
+}
+
+
+@dataclass
+class TraverseResult:
+    exam: str
+    pages: int
+    seconds: dict[str, float] = field(default_factory=dict)  # by traversal
+    same: bool = True  # whether every traversal found the same labels
+
+
+def compare_traversals(
+    spec: ExamSpec, filename: str, repeat: int = 1
+) -> TraverseResult:
+    """
+    Times searching the layout trees of an exam for every label with each of
+    TRAVERSALS. The pages are laid out once up front, so only the search is timed.
+    """
+
+    finder = PDFTextFinder(filename)
+    try:
+        trees = []
+        for idx, page in finder.iter_pages():
+            finder.interpreter.process_page(page)
+            trees.append((idx, finder.device.get_result()))  # type: ignore
+    finally:
+        finder.close()
+
+    result = TraverseResult(spec.name, spec.pages)
+    found = []
+    for name, traverse in TRAVERSALS.items():
+        result.seconds[name] = math.inf
+        for _ in range(repeat):
+            collection: dict[str, list[MatchLTTextLine]] = {
+                k: [] for k in question_splitter.SEARCH_PATTERNS
+            }
+            start = time.perf_counter()
+            for idx, tree in trees:
+                traverse(tree, question_splitter.SEARCH_PATTERNS, collection, idx)
+            result.seconds[name] = min(
+                result.seconds[name], time.perf_counter() - start
+            )
+        found.append(collection)
+
+    result.same = all(k == found[0] for k in found)
+    return result
+
+
+def format_result(result: BenchmarkResult) -> str:
+    peaks = [k.peak_bytes for k in result.stages.values() if k.peak_bytes]
+    peak = f"{max(peaks) / 1024 / 1024:7.1f}" if peaks else "      -"
+    times = "".join(f"{result.stages[k].seconds:9.3f}" for k in STAGES)
+    return (
+        f"{result.exam:<28}{result.engine:<8}{result.crop_backend:<9}"
+        f"{times}{peak}  {'ok' if result.ok else 'WRONG'}"
+    )
+
+
+@click.command()
+@click.option("--pages", multiple=True, type=int, default=[10, 100], show_default=True)
+@click.option(
+    "--questions-per-page", default=2, show_default=True, type=click.IntRange(1)
+)
+@click.option(
+    "--continued-every",
+    default=3,
+    show_default=True,
+    help="Every Nth page only continues the previous question. 0 for none.",
+)
+@click.option(
+    "--continued-labels/--no-continued-labels",
+    default=True,
+    show_default=True,
+    help="Label continuing pages with 'Question N (continued)'.",
+)
+@click.option(
+    "--section-every",
+    default=0,
+    show_default=True,
+    help="End a section after every Nth page of questions. 0 for none.",
+)
+@click.option(
+    "--density",
+    default=20,
+    show_default=True,
+    help="Lines of filler text per page.",
+)
+@click.option(
+    "--line-length",
+    default=80,
+    show_default=True,
+    help="Characters per line of filler text.",
+)
+@click.option(
+    "--engine",
+    "engines",
+    multiple=True,
+    type=click.Choice(file_parser.ENGINES),
+    help="Engines to compare. Defaults to every engine available.",
+)
+@click.option(
+    "--crop-backend",
+    "crop_backends",
+    multiple=True,
+    type=click.Choice(list(pdf_splitter.CROPPERS)),
+    default=["merge"],
+    show_default=True,
+)
+@click.option(
+    "--repeat",
+    default=1,
+    show_default=True,
+    help="Runs per exam, keeping the fastest time of each stage.",
+)
+@click.option(
+    "--traverse",
+    is_flag=True,
+    help="Also time searching the layout trees of each exam with the recursive search traverse_hierarchy replaced.",
+)
+@click.option(
+    "--plan-pages",
+    multiple=True,
+    type=int,
+    help="Also time planning question banks of this many pages, from their labels alone, to check planning scales linearly. Can be repeated.",
+)
+@click.option(
+    "--json",
+    "json_file",
+    default=None,
+    help="Also save the results to a JSON file, to compare between releases.",
+)
+def benchmark(
+    pages: tuple[int, ...],
+    questions_per_page: int,
+    continued_every: int,
+    continued_labels: bool,
+    section_every: int,
+    density: int,
+    line_length: int,
+    engines: tuple[str, ...],
+    crop_backends: tuple[str, ...],
+    repeat: int,
+    traverse: bool,
+    plan_pages: tuple[int, ...],
+    json_file: typing.Optional[str],
+):
+    """
+    Time every stage of splitting synthetic exams, and check the questions found.
+
+    Exits with 1 if any exam was split differently from how it was generated, or
+    with --traverse, if the traversals found different labels.
+    """
+
+    if not engines:
+        engines = tuple(
+            k for k in file_parser.ENGINES if k != "numpy" or file_parser.import_numpy()
+        )
+    specs = [
+        ExamSpec(
+            count,
+            questions_per_page,
+            continued_every,
+            continued_labels,
+            section_every,
+            density,
+            line_length,
+        )
+        for count in pages
+    ]
+
+    click.echo(
+        f"{'exam':<28}{'engine':<8}{'backend':<9}"
+        + "".join(f"{k:>9}" for k in STAGES)
+        + f"{'peak MB':>9}"
+    )
+    results = []
+    for result in run_benchmark(specs, engines, crop_backends, repeat):
+        results.append(result)
+        click.echo(format_result(result))
+        for error in result.errors:
+            click.echo(f"    {error}", err=True)
+
+    click.echo(
+        "Total: "
+        + ", ".join(
+            f"{k} {statistics.fsum(r.stages[k].seconds for r in results):.3f}s"
+            for k in STAGES
+        )
+    )
+
+    traversals = []
+    if traverse:
+        click.echo(
+            f"\n{'exam':<28}"
+            + "".join(f"{k:>11}" for k in TRAVERSALS)
+            + f"{'saving':>9}"
+        )
+        with tempfile.TemporaryDirectory() as folder:
+            for spec in specs:
+                filename = str(Path(folder) / f"{spec.name}.pdf")
+                generate_exam(spec, filename)
+                traversal = compare_traversals(spec, filename, repeat)
+                traversals.append(traversal)
+
+                seconds = traversal.seconds
+                click.echo(
+                    f"{traversal.exam:<28}"
+                    + "".join(f"{k:>11.3f}" for k in seconds.values())
+                    + f"{1 - seconds['iterative'] / seconds['recursive']:>9.0%}"
+                    + ("" if traversal.same else "  DIFFERENT")
+                )
+
+    if plan_pages:
+        click.echo(f"\n{'bank':<28}{'questions':>10}{'plan':>9}{'us/page':>9}")
+    for count in plan_pages:
+        spec = replace(specs[0], pages=count)
+        questions, seconds = time_planning(spec, repeat)
+        click.echo(
+            f"{spec.name:<28}{questions:>10}{seconds:>9.3f}"
+            f"{seconds / count * 1e6:>9.1f}"
+        )
+
+    if json_file:
+        with open(json_file, "w", encoding="utf-8") as f:
+            json.dump(
+                [{**asdict(k), "ok": k.ok} for k in results],
+                f,
+                indent=2,
+            )
+
+    if not all(k.ok for k in results) or not all(k.same for k in traversals):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import pickle
+import typing
+from pathlib import Path
+
+import instrument
+from atomic import write_atomically
+from source import PDFInput, SourcePDF
+
+# bump whenever the layout of cached values, or the plans they hold, change
+CACHE_VERSION = 2
+
+DEFAULT_CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "exam-splitter"
+)
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def hash_file(file: PDFInput, chunk_size: int = 1024 * 1024) -> str:
+    "SHA-256 of a file's contents"
+
+    if isinstance(file, SourcePDF):
+        return file.sha256
+
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_profile(patterns: typing.Mapping[str, typing.Pattern[str]]) -> str:
+    "SHA-256 of a set of labelled regexes, including their flags"
+
+    digest = hashlib.sha256()
+    for label, pattern in sorted(patterns.items()):
+        digest.update(f"{label}\0{pattern.pattern}\0{pattern.flags}\0".encode())
+    return digest.hexdigest()
+
+
+class SplitCache:
+    """
+    Content-addressed on-disk cache of split results, keyed by the hash of the input
+    file and the regex profile used to split it. Shared between the CLI and the GUI,
+    and safe to use from several processes at once.
+
+    Least recently used entries are evicted once the cache grows past `max_bytes`.
+    """
+
+    directory: Path
+    max_bytes: int
+
+    def __init__(
+        self,
+        directory: typing.Union[str, Path] = DEFAULT_CACHE_DIR,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(
+        file: PDFInput,
+        patterns: typing.Mapping[str, typing.Pattern[str]],
+        *options: str,
+    ) -> str:
+        "Cache key of a file split with the given regexes and any other options"
+
+        profile = hash_profile(patterns)
+        if options:
+            profile = hashlib.sha256(
+                "\0".join([profile, *options]).encode()
+            ).hexdigest()
+        return f"{CACHE_VERSION}-{hash_file(file)}-{profile}"
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.pickle"
+
+    def get(self, key: str) -> typing.Optional[object]:
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key: str, value: object) -> None:
+        """
+        Saves a value, leaving other processes to see either all of it or none.
+        The cache only saves work, so failing to write it doesn't stop a split.
+        """
+
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            write_atomically(
+                self.path(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            )
+            self.evict()
+        except OSError as e:
+            instrument.emit("message", message=f"Couldn't save to the cache: {e}")
+
+    def evict(self) -> None:
+        "Deletes least recently used entries until the cache fits in max_bytes"
+
+        entries: list[tuple[float, int, Path]] = []
+        for path in self.directory.glob("*.pickle"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue  # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink(missing_ok=True)
+            except OSError:
+                continue  # read-only; leave it for another process
+            total -= size
+
+    def clear(self) -> None:
+        for path in self.directory.glob("*.pickle"):
+            path.unlink(missing_ok=True)
@@ -0,0 +1,13 @@
+# names of the interchangeable parts of a split, kept free of heavy imports so the
+# CLI can offer them without loading pdfminer or PyPDF2
+
+# "layout" runs pdfminer's full layout analysis. "fast" collects character boxes
+# straight from the text-showing operators and only groups them into lines.
+# "numpy" is "fast" with the line grouping vectorised, for glyph-dense pages.
+ENGINES = ("layout", "fast", "numpy")
+
+# keys of pdf_splitter.CROPPERS
+CROP_BACKENDS = ("merge", "xobject")
+
+# formats of output.ArchiveOutput
+ARCHIVE_FORMATS = ("zip", "tar")
@@ -1,12 +1,29 @@
-import functools
-import re
+import itertools
+import json
+import time
 import typing
-from dataclasses import dataclass
+from dataclasses import astuple, dataclass
+from pathlib import Path
 
 from pdfminer.converter import PDFPageAggregator
 from pdfminer.layout import LAParams, LTComponent, LTTextLineHorizontal
+from pdfminer.pdfdevice import PDFDevice, PDFTextDevice
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdffont import PDFUnicodeNotDefined
 from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
-from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfpage import PDFPage, PDFTextExtractionNotAllowed
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
+from pdfminer.utils import isnumber
+
+import batch
+import instrument
+from cache import hash_file
+from choices import ENGINES
+from memory import MemoryLimit
+from source import PDFInput, SourcePDF, filename_of
+
+np: typing.Any = None  # NumPy, optional and only imported by the "numpy" engine
 
 # https://stackoverflow.com/questions/22898145/how-to-extract-text-and-text-coordinates-from-a-pdf-file
 
@@ -14,6 +31,19 @@ from pdfminer.pdfpage import PDFPage
 LTObject = typing.Union[LTComponent, PDFPage]
 
 
+def import_numpy() -> typing.Any:
+    "NumPy, imported on first use as it's slow to load, or None if not installed"
+
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
+
+
 @dataclass
 class MatchLTTextLine:
     x1: float
@@ -24,6 +54,361 @@ class MatchLTTextLine:
     result: str
 
 
+@dataclass
+class TextLine:
+    x1: float
+    y1: float
+    x2: float
+    y2: float
+    page: int  # page index starting at 0
+    text: str
+
+
+@dataclass
+class TextLineIndex:
+    """
+    Every text line of a PDF with its coordinates, as found by pdfminer's layout
+    analysis. Saved as a sidecar file so regexes can be searched again without
+    re-processing the PDF.
+    """
+
+    VERSION: typing.ClassVar[int] = 2
+
+    sha256: str  # hash of the indexed PDF
+    engine: str  # engine the lines were found with
+    page_count: int
+    lines: list[TextLine]
+
+    def find_all_matches(
+        self, regexes: typing.Mapping[str, typing.Pattern[str]]
+    ) -> dict[str, list[MatchLTTextLine]]:
+        "Same results as PDFTextFinder.find_all_matches, without touching the PDF"
+
+        return match_lines(self.lines, regexes, {k: [] for k in regexes})
+
+    def save(self, path: typing.Union[str, Path]) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": self.VERSION,
+                    "sha256": self.sha256,
+                    "engine": self.engine,
+                    "page_count": self.page_count,
+                    "lines": [astuple(k) for k in self.lines],
+                },
+                f,
+                separators=(",", ":"),
+            )
+
+    @classmethod
+    def load(cls, path: typing.Union[str, Path]) -> "TextLineIndex":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+
+        if data.get("version") != cls.VERSION:
+            raise ValueError(f"Unsupported line index version in {path}")
+        return cls(
+            data["sha256"],
+            data["engine"],
+            data["page_count"],
+            [TextLine(*k) for k in data["lines"]],
+        )
+
+    @staticmethod
+    def sidecar_path(filename: str, engine: str = "layout") -> Path:
+        # one per engine, so falling back to layout doesn't replace the other index
+        if engine == "layout":
+            return Path(f"{filename}.lines.json")
+        return Path(f"{filename}.{engine}.lines.json")
+
+
+def load_or_build_index(
+    file: PDFInput,
+    workers: int = 1,
+    engine: str = "layout",
+    memory_limit: typing.Optional[MemoryLimit] = None,
+) -> TextLineIndex:
+    """
+    Loads the sidecar line index of a PDF for `engine`, building and saving it first
+    if it is missing, or was made from a different version of the file.
+    """
+
+    sha256 = hash_file(file)
+    sidecar = TextLineIndex.sidecar_path(filename_of(file), engine)
+
+    try:
+        index = TextLineIndex.load(sidecar)
+        if index.sha256 == sha256 and index.engine == engine:
+            return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    finder = PDFTextFinder(
+        file, workers=workers, engine=engine, memory_limit=memory_limit
+    )
+    try:
+        index = TextLineIndex(
+            sha256, engine, finder.page_count, finder.collect_all_lines()
+        )
+    finally:
+        finder.close()
+
+    try:
+        index.save(sidecar)
+    except OSError:
+        pass  # read-only folder; the index still works for this run
+
+    return index
+
+
+def match_lines(
+    lines: typing.Iterable[TextLine],
+    regexes: typing.Mapping[str, typing.Pattern[str]],
+    collection: dict[str, list[MatchLTTextLine]],
+    verbose: bool = False,
+) -> dict[str, list[MatchLTTextLine]]:
+    "Adds every line matching one of the regexes to that regex's bucket"
+
+    for line in lines:
+        for label, regex in regexes.items():
+            if match := regex.search(line.text):
+                question_box = MatchLTTextLine(
+                    line.x1, line.y1, line.x2, line.y2, line.page, match.group(1)
+                )
+                collection[label].append(question_box)
+
+                if verbose:
+                    instrument.emit(
+                        "match", page=line.page, message=f"{label}: {line.text}"
+                    )
+    return collection
+
+
+# x0, y0, x1, y1, text of a single character
+CharBox = tuple[float, float, float, float, str]
+
+
+class CharBoxDevice(PDFTextDevice):
+    """
+    pdfminer device for the "fast" engine. Records a plain CharBox for every
+    character drawn by the page's text-showing operators, instead of building LTChar
+    objects for a layout analysis. Like LAParams, text inside figures is ignored.
+    """
+
+    chars: list[CharBox]
+
+    def __init__(self, rsrcmgr: PDFResourceManager):
+        super().__init__(rsrcmgr)
+        self.chars = []
+        self.figure_depth = 0
+
+    def begin_page(self, page: PDFPage, ctm: tuple[float, ...]) -> None:
+        self.chars = []
+
+    def begin_figure(self, name: str, bbox: typing.Any, matrix: typing.Any) -> None:
+        self.figure_depth += 1
+
+    def end_figure(self, name: str) -> None:
+        self.figure_depth -= 1
+
+    def render_string_vertical(self, seq, matrix, pos, *args):  # type: ignore
+        return pos  # exam papers don't use vertical writing
+
+    def render_string_horizontal(  # type: ignore
+        self,
+        seq,
+        matrix,
+        pos,
+        font,
+        fontsize,
+        scaling,
+        charspace,
+        wordspace,
+        rise,
+        dxscale,
+    ):
+        # mirrors PDFTextDevice.render_string_horizontal and LTChar's bounding box
+        x, y = pos
+        a, b, c, d, e, f = matrix
+        bottom = font.get_descent() * fontsize + rise
+        top = bottom + font.get_height() * fontsize
+        record = not self.figure_depth
+
+        needcharspace = False
+        for obj in seq:
+            if isnumber(obj):
+                x -= obj * dxscale
+                needcharspace = True
+                continue
+
+            for cid in font.decode(obj):
+                if needcharspace:
+                    x += charspace
+                adv = font.char_width(cid) * fontsize * scaling
+
+                if record:
+                    try:
+                        text = font.to_unichr(cid)
+                    except PDFUnicodeNotDefined:
+                        text = f"(cid:{cid})"
+
+                    x0 = a * x + c * (y + bottom) + e
+                    y0 = b * x + d * (y + bottom) + f
+                    x1 = a * (x + adv) + c * (y + top) + e
+                    y1 = b * (x + adv) + d * (y + top) + f
+                    self.chars.append(
+                        (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1), text)
+                    )
+
+                x += adv
+                if cid == 32 and wordspace:
+                    x += wordspace
+                needcharspace = True
+        return (x, y)
+
+
+def group_chars_into_lines(
+    chars: typing.Iterable[CharBox], page: int, laparams: LAParams = LAParams()
+) -> list[TextLine]:
+    """
+    Groups characters, in content stream order, into horizontal lines using the
+    same neighbour test as pdfminer's LTLayoutContainer.group_objects, without
+    its text box clustering. Lines are returned top to bottom, left to right.
+    """
+
+    lines: list[TextLine] = []
+    current: list[CharBox] = []
+
+    def _flush():
+        text = []
+        last_x1 = float("inf")
+        for x0, y0, x1, y1, char in current:
+            # virtual spaces, as added by LTTextLineHorizontal.add
+            if last_x1 < x0 - laparams.word_margin * max(x1 - x0, y1 - y0):
+                text.append(" ")
+            text.append(char)
+            last_x1 = x1
+
+        if stripped := "".join(text).strip():
+            lines.append(
+                TextLine(
+                    min(k[0] for k in current),
+                    min(k[1] for k in current),
+                    max(k[2] for k in current),
+                    max(k[3] for k in current),
+                    page,
+                    stripped,
+                )
+            )
+        current.clear()
+
+    obj0: typing.Optional[CharBox] = None
+    for obj1 in chars:
+        if obj0 is not None:
+            (ax0, ay0, ax1, ay1, _), (bx0, by0, bx1, by1, _) = obj0, obj1
+
+            # LTComponent.is_voverlap / voverlap / hdistance, inlined
+            halign = (
+                by0 <= ay1
+                and ay0 <= by1
+                and min(ay1 - ay0, by1 - by0) * laparams.line_overlap
+                < min(abs(ay0 - by1), abs(ay1 - by0))
+                and (
+                    0
+                    if bx0 <= ax1 and ax0 <= bx1
+                    else min(abs(ax0 - bx1), abs(ax1 - bx0))
+                )
+                < max(ax1 - ax0, bx1 - bx0) * laparams.char_margin
+            )
+
+            if halign and current:
+                current.append(obj1)
+            elif current:
+                # obj1 starts the next line, as obj0 of the next iteration
+                _flush()
+            elif halign:
+                current.extend((obj0, obj1))
+            else:
+                current.append(obj0)
+                _flush()
+        obj0 = obj1
+
+    if not current and obj0 is not None:
+        current.append(obj0)
+    if current:
+        _flush()
+
+    lines.sort(key=lambda k: (-k.y2, k.x1))
+    return lines
+
+
+def group_chars_into_lines_numpy(
+    chars: typing.Sequence[CharBox], page: int, laparams: LAParams = LAParams()
+) -> list[TextLine]:
+    """
+    Vectorised group_chars_into_lines. The neighbour test is evaluated for every
+    consecutive pair of characters at once, and a line ends wherever it fails.
+    """
+
+    if not chars:
+        return []
+
+    boxes = np.array([k[:4] for k in chars], dtype=float)
+    x0, y0, x1, y1 = boxes.T
+    width, height = x1 - x0, y1 - y0
+
+    # neighbour test between each character and the next one
+    ax0, ay0, ax1, ay1 = x0[:-1], y0[:-1], x1[:-1], y1[:-1]
+    bx0, by0, bx1, by1 = x0[1:], y0[1:], x1[1:], y1[1:]
+    hdistance = np.where(
+        (bx0 <= ax1) & (ax0 <= bx1),
+        0,
+        np.minimum(np.abs(ax0 - bx1), np.abs(ax1 - bx0)),
+    )
+    halign = (
+        (by0 <= ay1)
+        & (ay0 <= by1)
+        & (
+            np.minimum(height[:-1], height[1:]) * laparams.line_overlap
+            < np.minimum(np.abs(ay0 - by1), np.abs(ay1 - by0))
+        )
+        & (hdistance < np.maximum(width[:-1], width[1:]) * laparams.char_margin)
+    )
+
+    # virtual spaces, as added by LTTextLineHorizontal.add
+    spaced = np.zeros(len(chars), dtype=bool)
+    spaced[1:] = halign & (
+        ax1 < bx0 - laparams.word_margin * np.maximum(width[1:], height[1:])
+    )
+
+    starts = np.flatnonzero(np.concatenate(([True], ~halign)))
+    ends = np.append(starts[1:], len(chars))
+
+    line_x0 = np.minimum.reduceat(x0, starts)
+    line_y0 = np.minimum.reduceat(y0, starts)
+    line_x1 = np.maximum.reduceat(x1, starts)
+    line_y1 = np.maximum.reduceat(y1, starts)
+
+    parts = [" " + k[4] if space else k[4] for k, space in zip(chars, spaced)]
+
+    lines: list[TextLine] = []
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        if text := "".join(parts[start:end]).strip():
+            lines.append(
+                TextLine(
+                    float(line_x0[i]),
+                    float(line_y0[i]),
+                    float(line_x1[i]),
+                    float(line_y1[i]),
+                    page,
+                    text,
+                )
+            )
+
+    lines.sort(key=lambda k: (-k.y2, k.x1))
+    return lines
+
+
 class PDFTextFinder:
     """
     Finds a specific regex within the text content of a PDF, with the coordinates
@@ -32,100 +417,313 @@ class PDFTextFinder:
     Note: does not search multiline.
     """
 
-    pages: list[PDFPage]
-    device: PDFPageAggregator
+    filename: str
+    workers: int
+    engine: str
+    document: PDFDocument
+    page_count: int
+    device: PDFDevice
     interpreter: PDFPageInterpreter
     file: typing.Optional[typing.BinaryIO]
+    memory_limit: typing.Optional[MemoryLimit]
+
+    def __init__(
+        self,
+        file: PDFInput,
+        workers: int = 1,
+        engine: str = "layout",
+        memory_limit: typing.Optional[MemoryLimit] = None,
+    ):
+        """
+        `file` is a filename, or a SourcePDF to share with the rest of the run.
+        `workers` > 1 shards the pages across that many processes, each with its
+        own resource manager and interpreter. `engine` is one of ENGINES. With a
+        `memory_limit`, parsed objects are released after any page that leaves the
+        process over it.
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+        if engine == "numpy" and import_numpy() is None:
+            raise ImportError("The numpy engine needs NumPy installed")
 
-    def __init__(self, filename: str):
-        self.pages, self.device, self.interpreter, self.file = self.extract_pages(
-            filename
+        # a source opened here is closed with the finder
+        self._source = SourcePDF(file) if isinstance(file, str) else None
+        source = self._source or typing.cast(SourcePDF, file)
+
+        self.filename = source.filename
+        self.workers = workers
+        self.engine = engine
+        self.memory_limit = memory_limit
+        self.document, self.device, self.interpreter, self.file = self.extract_pages(
+            source, engine
         )
+        self.page_count = self.count_pages(self.document)
 
     def find_matches(
         self, matching_regex: typing.Pattern[str]
     ) -> list[MatchLTTextLine]:
+        return self.find_all_matches({"match": matching_regex})["match"]
+
+    def find_all_matches(
+        self, regexes: typing.Mapping[str, typing.Pattern[str]]
+    ) -> dict[str, list[MatchLTTextLine]]:
+        """
+        Searches for several regexes at once. Each page is interpreted and laid out
+        a single time, and every text line is checked against all regexes.
+        """
         assert self.file, IOError("File already closed.")
 
-        def _page_scan(results: list[MatchLTTextLine], page_data: tuple[int, PDFPage]):
-            idx, page = page_data  # unpack
+        shards = self.shard_pages(self.page_count, self.workers)
+        if len(shards) <= 1:
+            return self.scan_pages(self.iter_pages(), regexes)
 
-            self.interpreter.process_page(page)
-            layout = typing.cast(PDFPage, self.device.get_result())
-            return self.traverse_hierarchy(
-                layout, regex=matching_regex, depth=0, collection=results, page=idx
+        with batch.worker_pool(len(shards)) as executor:
+            shard_results = list(
+                executor.map(
+                    _scan_page_range,
+                    itertools.repeat(self.filename),
+                    shards,
+                    itertools.repeat(regexes),
+                    itertools.repeat(self.engine),
+                    itertools.repeat(self.memory_limit),
+                )
             )
 
-        print("x1  y1  x2  y2   text")
-        return functools.reduce(
-            _page_scan, enumerate(self.pages), typing.cast(list[MatchLTTextLine], [])
+        # executor.map returns results in submission order, so concatenating the
+        # shards keeps the matches in page order, exactly as the serial path does
+        return {
+            label: [match for result in shard_results for match in result[label]]
+            for label in regexes
+        }
+
+    def iter_page_matches(
+        self, regexes: typing.Mapping[str, typing.Pattern[str]]
+    ) -> typing.Iterator[tuple[int, dict[str, list[MatchLTTextLine]]]]:
+        """
+        Like find_all_matches, but yields (page index, matches) for each page as soon
+        as it has been scanned. Always runs serially.
+        """
+        assert self.file, IOError("File already closed.")
+        for page_data in self.iter_pages():
+            yield page_data[0], self.scan_pages([page_data], regexes)
+
+    def collect_all_lines(self) -> list[TextLine]:
+        "Lays out every page once and records all of its text lines, in page order"
+
+        assert self.file, IOError("File already closed.")
+
+        shards = self.shard_pages(self.page_count, self.workers)
+        if len(shards) <= 1:
+            return self.collect_lines(self.iter_pages())
+
+        with batch.worker_pool(len(shards)) as executor:
+            shard_results = executor.map(
+                _collect_page_range,
+                itertools.repeat(self.filename),
+                shards,
+                itertools.repeat(self.engine),
+                itertools.repeat(self.memory_limit),
+            )
+            return [line for result in shard_results for line in result]
+
+    def iter_pages(
+        self, page_range: typing.Optional[range] = None
+    ) -> typing.Iterator[tuple[int, PDFPage]]:
+        "(page index, page) pairs, each page only loaded once it is reached"
+
+        pages = enumerate(PDFPage.create_pages(self.document))
+        if page_range is None:
+            return pages
+        return itertools.islice(pages, page_range.start, page_range.stop)
+
+    def collect_lines(
+        self, pages: typing.Iterable[tuple[int, PDFPage]]
+    ) -> list[TextLine]:
+        "Collects the text lines of (page index, page) pairs, in traversal order."
+
+        lines: list[TextLine] = []
+        for idx, page in pages:
+            lines.extend(self.page_lines(idx, page))
+        return lines
+
+    def page_lines(self, idx: int, page: PDFPage) -> list[TextLine]:
+        "Text lines of a single page, found with this finder's engine"
+
+        start = time.perf_counter()
+        self.interpreter.process_page(page)
+
+        if isinstance(self.device, CharBoxDevice):
+            if self.engine == "numpy":
+                lines = group_chars_into_lines_numpy(self.device.chars, idx)
+            else:
+                lines = group_chars_into_lines(self.device.chars, idx)
+        else:
+            layout = typing.cast(
+                PDFPage, typing.cast(PDFPageAggregator, self.device).get_result()
+            )
+            lines = [
+                TextLine(*line.bbox, idx, text)
+                for line in self.iter_text_lines(layout)
+                if (text := line.get_text().strip())
+            ]
+
+        if self.memory_limit:
+            self.memory_limit.check(self.release)
+
+        instrument.emit(
+            "page",
+            file=self.filename,
+            page=idx,
+            pages=self.page_count,
+            duration=time.perf_counter() - start,
+        )
+        return lines
+
+    def scan_pages(
+        self,
+        pages: typing.Iterable[tuple[int, PDFPage]],
+        regexes: typing.Mapping[str, typing.Pattern[str]],
+    ) -> dict[str, list[MatchLTTextLine]]:
+        "Scans (page index, page) pairs with this finder's interpreter."
+
+        return match_lines(
+            (line for idx, page in pages for line in self.page_lines(idx, page)),
+            regexes,
+            {k: [] for k in regexes},
+            verbose=True,
         )
 
+    def release(self) -> None:
+        "Drops the page layout and parsed objects, which are re-read as needed"
+
+        if isinstance(self.device, PDFPageAggregator):
+            self.device.result = None
+        self.document._cached_objs.clear()  # type: ignore
+        self.document._parsed_objs.clear()  # type: ignore
+        self.interpreter.rsrcmgr._cached_fonts.clear()  # type: ignore
+
     def close(self) -> None:
         if self.file:
             self.file.close()
         self.file = None
+        if self._source:
+            self._source.close()
+            self._source = None
 
     @staticmethod
     def extract_pages(
-        filename: str,
-    ) -> tuple[list[PDFPage], PDFPageAggregator, PDFPageInterpreter, typing.BinaryIO]:
+        source: SourcePDF,
+        engine: str = "layout",
+    ) -> tuple[PDFDocument, PDFDevice, PDFPageInterpreter, typing.BinaryIO]:
         rsrcmgr = PDFResourceManager()
-        laparams = LAParams()
-        device = PDFPageAggregator(rsrcmgr, laparams=laparams)
+        if engine in {"fast", "numpy"}:
+            device = CharBoxDevice(rsrcmgr)
+        else:
+            device = PDFPageAggregator(rsrcmgr, laparams=LAParams())
         interpreter = PDFPageInterpreter(rsrcmgr, device)
 
-        fp = open(filename, "rb")
-        pages = list(PDFPage.get_pages(fp))
+        # only the cross-reference table is parsed here; pages are loaded lazily
+        fp = source.view()
+        document = PDFDocument(PDFParser(fp))
+        if not document.is_extractable:
+            raise PDFTextExtractionNotAllowed(
+                f"Text extraction is not allowed: {source.filename}"
+            )
 
-        return pages, device, interpreter, fp
+        return document, device, interpreter, fp
 
     @staticmethod
-    def traverse_hierarchy(
-        o: LTObject,
-        regex: typing.Pattern[str],
-        depth: int = 0,
-        collection: list[MatchLTTextLine] = [],
-        page: int = 0,
-    ) -> list[MatchLTTextLine]:
-        "Recursively traverses an object tree. Searches all text."
+    def count_pages(document: PDFDocument) -> int:
+        "Number of pages in a document, from its page tree when it has one"
 
-        if text := PDFTextFinder.get_optional_text(o):
-            results = re.search(regex, text)
+        if "Pages" in document.catalog:
+            count = resolve1(resolve1(document.catalog["Pages"]).get("Count"))
+            if isinstance(count, int):
+                return count
+        return sum(1 for _ in PDFPage.create_pages(document))
 
-            if isinstance(o, LTTextLineHorizontal) and results:
-                bbox: tuple[float, float, float, float] = o.bbox
-                num = results.group(1)
+    @staticmethod
+    def shard_pages(page_count: int, workers: int) -> list[range]:
+        "Splits page indices into at most `workers` contiguous, ordered ranges."
 
-                question_box = MatchLTTextLine(*bbox, page, num)
-                collection.append(question_box)
+        shard_count = max(1, min(workers, page_count))
+        size, extra = divmod(page_count, shard_count)
 
-                print(
-                    f"{PDFTextFinder.get_optional_bbox(o)} "
-                    f"{question_box.result}\t{text}"
-                )
+        shards: list[range] = []
+        start = 0
+        for i in range(shard_count):
+            stop = start + size + (i < extra)
+            shards.append(range(start, stop))
+            start = stop
+        return shards
 
-        if isinstance(o, typing.Iterable):
-            o_casted = typing.cast(typing.Iterable[LTObject], o)
+    @staticmethod
+    def iter_text_lines(o: LTObject) -> typing.Iterator[LTTextLineHorizontal]:
+        """
+        Yields every horizontal text line in an object tree, depth first. Doesn't
+        descend into lines, so characters are never visited.
+        """
 
-            for i in o_casted:
-                collection = PDFTextFinder.traverse_hierarchy(
-                    i, regex=regex, depth=depth + 1, collection=collection, page=page
+        stack = [o]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, LTTextLineHorizontal):
+                yield item
+            elif isinstance(item, typing.Iterable):
+                # reversed so children are popped, and yielded, in document order
+                stack.extend(
+                    reversed(list(typing.cast(typing.Iterable[LTObject], item)))
                 )
-        return collection
 
     @staticmethod
-    def get_optional_bbox(o: LTObject) -> str:
-        """Bounding box of LTItem if available, otherwise empty string"""
+    def traverse_hierarchy(
+        o: LTObject,
+        regexes: typing.Mapping[str, typing.Pattern[str]],
+        collection: typing.Optional[dict[str, list[MatchLTTextLine]]] = None,
+        page: int = 0,
+    ) -> dict[str, list[MatchLTTextLine]]:
+        """
+        Searches the text lines of an object tree. Only line text is built and
+        searched, as containers rebuild theirs from every character they hold.
+        """
 
-        if hasattr(o, "bbox"):
-            return "".join(f"{i:<4.0f}" for i in o.bbox)  # type: ignore
-        return ""
+        if collection is None:
+            collection = {k: [] for k in regexes}
 
-    @staticmethod
-    def get_optional_text(o: LTObject) -> str:
-        """Text of LTItem if available, otherwise empty string"""
+        lines = (
+            TextLine(*line.bbox, page, text)
+            for line in PDFTextFinder.iter_text_lines(o)
+            if (text := line.get_text().strip())
+        )
+        return match_lines(lines, regexes, collection, verbose=True)
+
+
+def _scan_page_range(
+    filename: str,
+    page_range: range,
+    regexes: typing.Mapping[str, typing.Pattern[str]],
+    engine: str,
+    memory_limit: typing.Optional[MemoryLimit],
+) -> dict[str, list[MatchLTTextLine]]:
+    "Process pool entry point: scans one shard of pages with a fresh finder."
+
+    finder = PDFTextFinder(filename, engine=engine, memory_limit=memory_limit)
+    try:
+        return finder.scan_pages(finder.iter_pages(page_range), regexes)
+    finally:
+        finder.close()
+
+
+def _collect_page_range(
+    filename: str,
+    page_range: range,
+    engine: str,
+    memory_limit: typing.Optional[MemoryLimit],
+) -> list[TextLine]:
+    "Process pool entry point: collects the lines of one shard of pages."
 
-        if hasattr(o, "get_text"):
-            return o.get_text().strip()  # type: ignore
-        return ""
+    finder = PDFTextFinder(filename, engine=engine, memory_limit=memory_limit)
+    try:
+        return finder.collect_lines(finder.iter_pages(page_range))
+    finally:
+        finder.close()
@@ -1,6 +1,9 @@
+import functools
+import multiprocessing
+import os
 import sys
+import threading
 import typing
-from pathlib import Path
 
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtWidgets import (
@@ -14,34 +17,55 @@ from PyQt5.QtWidgets import (
     QProgressBar,
     QPushButton,
     QSizePolicy,
+    QSpinBox,
     QVBoxLayout,
     QWidget,
 )
 
+import batch
+import instrument
 import main
+from cache import SplitCache
 
 
 class FileProcessThread(QtCore.QThread):
-    progress = QtCore.pyqtSignal(int)
+    progress = QtCore.pyqtSignal(int, float)  # files completed, fraction of all work
     error_signal = QtCore.pyqtSignal(str)
     files: list[str]
 
+    # share of a file's progress for scanning its pages; the rest is writing
+    SCANNING = 0.8
+
     def __init__(
-        self, files: list[str], callback: typing.Callable[[str], None]
+        self, files: list[str], callback: typing.Callable[[str], None], jobs: int = 1
     ) -> None:
         super().__init__()
         self.files = files
         self.callback = callback
+        self.jobs = jobs
+
+        self._completed = 0
+        self._file_progress: dict[str, float] = {}  # fraction done of each file
+        # events arrive on the threads forwarding them from worker processes
+        self._progress_lock = threading.Lock()
 
     def __del__(self) -> None:
         self.wait()
 
     def run(self) -> None:
         try:
-            for idx, file in enumerate(self.files):
-                self.callback(file)
-
-                self.progress.emit(idx)
+            with instrument.installed(instrument.CallbackSink(self.on_event)):
+                results = batch.process_files(self.files, self.callback, self.jobs)
+                for completed, result in enumerate(results, start=1):
+                    if not result.ok:
+                        sys.stderr.write(f"{result.file}\n{result.error}\n")
+                        sys.stderr.flush()
+                        self.error_signal.emit(f"{result.file}\n\n{result.error}")
+
+                    with self._progress_lock:
+                        self._completed = completed
+                        self._file_progress[result.file] = 1.0
+                    self.emit_progress()
         except Exception:
             import traceback
 
@@ -50,6 +74,22 @@ class FileProcessThread(QtCore.QThread):
             sys.stderr.flush()
             self.error_signal.emit(exc)
 
+    def on_event(self, event: instrument.Event) -> None:
+        "Moves the progress bar on every scanned page, from any thread"
+
+        if event.kind == "page" and event.file and event.pages:
+            with self._progress_lock:
+                self._file_progress[event.file] = (
+                    ((event.page or 0) + 1) / event.pages * self.SCANNING
+                )
+            self.emit_progress()
+
+    def emit_progress(self) -> None:
+        with self._progress_lock:
+            completed = self._completed
+            fraction = sum(self._file_progress.values()) / max(1, len(self.files))
+        self.progress.emit(completed, fraction)
+
 
 class EditableList(QListWidget):
     def __init__(self, parent: typing.Optional[QWidget] = None) -> None:
@@ -136,8 +176,14 @@ class MainWindow(QWidget):
         startButton.clicked.connect(self.process_files)
         closeButton.clicked.connect(lambda _: sys.exit())
 
+        self.jobsInput = QSpinBox()
+        self.jobsInput.setRange(1, os.cpu_count() or 1)
+        self.jobsInput.setValue(os.cpu_count() or 1)
+
         confirmRow.addWidget(self.progressLabel)
         confirmRow.addStretch()
+        confirmRow.addWidget(QLabel("Files at once:"))
+        confirmRow.addWidget(self.jobsInput)
         confirmRow.addWidget(startButton)
         confirmRow.addWidget(closeButton)
 
@@ -168,24 +214,22 @@ class MainWindow(QWidget):
         self.files_to_progress = [
             self.files_list.item(i).text() for i in range(self.files_list.count())
         ]
-        self.process_thread = FileProcessThread(self.files_to_progress, self.callback)
+        self.process_thread = FileProcessThread(
+            self.files_to_progress, self.callback, self.jobsInput.value()
+        )
 
         self.process_thread.progress.connect(self.update_progress_bar)
         self.process_thread.error_signal.connect(self.display_error_dialog)
         self.process_thread.start()
-        self.update_progress_bar(-1)
+        self.update_progress_bar(0, 0.0)
 
-    def update_progress_bar(self, progress_idx: int) -> None:
-        self.progress.setValue(
-            int((progress_idx + 1) / len(self.files_to_progress) * 100)
-        )
+    def update_progress_bar(self, completed: int, fraction: float) -> None:
+        total = len(self.files_to_progress)
 
-        try:
-            next_file = self.files_to_progress[progress_idx + 1]
-            self.progressLabel.setText(
-                f"> {Path(next_file).stem} ({progress_idx+1} / {len(self.files_to_progress)})"
-            )
-        except IndexError:
+        if completed < total:
+            self.progress.setValue(int(fraction * 100))
+            self.progressLabel.setText(f"Processed {completed} / {total}")
+        else:
             self.progress.setValue(100)
             self.progressLabel.setText("Done")
 
@@ -197,7 +241,6 @@ class MainWindow(QWidget):
         msg.setInformativeText(err)
         msg.setWindowTitle("Error")
         msg.setStandardButtons(QMessageBox.Ok)
-        msg.buttonClicked.connect(sys.exit)  # type: ignore
 
         msg.exec_()
 
@@ -212,4 +255,5 @@ def _main(callback: typing.Callable[[str], None]):
 
 
 if __name__ == "__main__":
-    _main(main.extract_questions_from_file)
+    multiprocessing.freeze_support()
+    _main(functools.partial(main.extract_questions_from_file, cache=SplitCache()))
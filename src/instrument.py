@@ -0,0 +1,238 @@
+import abc
+import collections
+import contextlib
+import contextvars
+import cProfile
+import json
+import multiprocessing
+import sys
+import threading
+import time
+import typing
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+STAGES = ("detect", "plan", "crop", "write")
+
+
+@dataclass
+class Event:
+    "Something that happened while processing a file"
+
+    kind: str  # "file", "stage", "page", "question", "match" or "message"
+    file: typing.Optional[str] = None
+    stage: typing.Optional[str] = None  # one of STAGES
+    page: typing.Optional[int] = None  # page index starting at 0
+    pages: typing.Optional[int] = None  # page count of the file
+    question: typing.Optional[int] = None
+    duration: typing.Optional[float] = None  # seconds
+    bytes: typing.Optional[int] = None  # written
+    message: typing.Optional[str] = None
+    time: float = field(default_factory=time.time)
+
+
+class Sink(abc.ABC):
+    "Receives every event emitted while it is installed"
+
+    @abc.abstractmethod
+    def emit(self, event: Event) -> None: ...
+
+    def close(self) -> None:
+        pass
+
+
+class SilentSink(Sink):
+    "Drops every event"
+
+    def emit(self, event: Event) -> None:
+        pass
+
+
+class JSONLinesSink(Sink):
+    "Writes every event as a line of JSON, leaving out empty fields"
+
+    def __init__(self, stream: typing.Optional[typing.TextIO] = None):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def emit(self, event: Event) -> None:
+        line = json.dumps({k: v for k, v in asdict(event).items() if v is not None})
+        stream = self.stream or sys.stdout
+        with self._lock:
+            stream.write(line + "\n")
+            stream.flush()
+
+
+class SummarySink(Sink):
+    "Echoes messages as they come, and a table of where the time went when closed"
+
+    COLUMNS: typing.ClassVar[tuple[str, ...]] = ("pages", "questions", "bytes")
+
+    def __init__(self, stream: typing.Optional[typing.TextIO] = None):
+        self.stream = stream
+        self.files: dict[str, collections.Counter[str]] = {}
+        self.questions: dict[str, set[int]] = {}  # planned or written, by file
+        self._lock = threading.Lock()
+
+    def emit(self, event: Event) -> None:
+        stream = self.stream or sys.stdout
+        with self._lock:
+            if event.kind == "message":
+                stream.write(f"{event.message}\n")
+
+            row = self.files.setdefault(event.file or "", collections.Counter())
+            if event.kind == "page":
+                row["pages"] += 1
+            elif event.kind == "file":
+                row["total"] += event.duration or 0
+            elif event.kind in ("stage", "question") and event.stage:
+                row[event.stage] += event.duration or 0
+                if event.kind == "question" and event.question is not None:
+                    # planning, cropping and writing all count the same question
+                    questions = self.questions.setdefault(event.file or "", set())
+                    questions.add(event.question)
+                    row["questions"] = len(questions)
+                if event.kind == "question" and event.stage == "write":
+                    row["bytes"] += event.bytes or 0
+
+    def close(self) -> None:
+        rows = {k: v for k, v in self.files.items() if k and v}
+        if not rows:
+            return
+
+        stream = self.stream or sys.stdout
+        width = max(len(Path(k).name) for k in rows) + 2
+        stream.write(
+            f"{'file':<{width}}{'pages':>7}{'questions':>10}{'KB':>9}"
+            + "".join(f"{k:>9}" for k in (*STAGES, "total"))
+            + "\n"
+        )
+        for file, row in rows.items():
+            stream.write(
+                f"{Path(file).name:<{width}}{row['pages']:>7}{row['questions']:>10}"
+                f"{row['bytes'] / 1024:>9.0f}"
+                + "".join(f"{row[k]:>9.3f}" for k in (*STAGES, "total"))
+                + "\n"
+            )
+
+
+class CallbackSink(Sink):
+    "Calls a function with every event, on whichever thread emits it"
+
+    def __init__(self, callback: typing.Callable[[Event], None]):
+        self.callback = callback
+
+    def emit(self, event: Event) -> None:
+        self.callback(event)
+
+
+class QueueSink(Sink):
+    "Puts every event on a queue, for a QueueForwarder in another process"
+
+    def __init__(self, queue: "multiprocessing.Queue[typing.Optional[Event]]"):
+        self.queue = queue
+
+    def emit(self, event: Event) -> None:
+        self.queue.put(event)
+
+
+class QueueForwarder:
+    "Emits the events put on `queue` by QueueSinks in other processes to `sink`"
+
+    def __init__(self, sink: Sink):
+        self.sink = sink
+        self.queue: "multiprocessing.Queue[typing.Optional[Event]]" = (
+            multiprocessing.Queue()
+        )
+        self._thread = threading.Thread(target=self._forward, daemon=True)
+        self._thread.start()
+
+    def _forward(self) -> None:
+        while event := self.queue.get():
+            self.sink.emit(event)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self._thread.join()
+
+
+SINKS: dict[str, typing.Callable[[], Sink]] = {
+    "summary": SummarySink,
+    "jsonl": JSONLinesSink,
+    "silent": SilentSink,
+}
+
+_sink: Sink = SilentSink()
+_file: contextvars.ContextVar[typing.Optional[str]] = contextvars.ContextVar(
+    "file", default=None
+)
+
+
+def current() -> Sink:
+    return _sink
+
+
+def install(sink: Sink) -> Sink:
+    "Sends every event of this process to `sink`, returning the previous one"
+
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+def install_queue(queue: "multiprocessing.Queue[typing.Optional[Event]]") -> None:
+    "Process pool initializer sending the events of a worker to a QueueForwarder"
+
+    install(QueueSink(queue))
+
+
+@contextlib.contextmanager
+def installed(sink: Sink) -> typing.Iterator[Sink]:
+    previous = install(sink)
+    try:
+        yield sink
+    finally:
+        install(previous)
+
+
+def emit(kind: str, **fields: typing.Any) -> None:
+    "Emits an event, of the file being processed unless given another"
+
+    fields.setdefault("file", _file.get())
+    _sink.emit(Event(kind, **fields))
+
+
+@contextlib.contextmanager
+def stage(name: str, **fields: typing.Any) -> typing.Iterator[None]:
+    "Times the block, emitting it as a stage of the file being processed"
+
+    start = time.perf_counter()
+    yield
+    emit("stage", stage=name, duration=time.perf_counter() - start, **fields)
+
+
+@contextlib.contextmanager
+def processing(
+    file: str, profile_dir: typing.Optional[str] = None
+) -> typing.Iterator[None]:
+    """
+    Tags the events of the block with `file`, then emits how long it took. With a
+    `profile_dir`, the block also runs under cProfile, and its stats are saved
+    there as FILE.prof.
+    """
+
+    token = _file.set(file)
+    profiler = cProfile.Profile() if profile_dir else None
+    start = time.perf_counter()
+    try:
+        if profiler:
+            profiler.enable()
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            folder = Path(typing.cast(str, profile_dir))
+            folder.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(folder / f"{Path(file).name}.prof")
+        emit("file", duration=time.perf_counter() - start)
+        _file.reset(token)
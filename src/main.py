@@ -1,3 +1,34 @@
+import contextvars
+import functools
+import multiprocessing
+import queue
+import re
+import sys
+import threading
+import time
+import typing
+from pathlib import Path
+
+import click
+
+import batch
+import instrument
+from cache import DEFAULT_CACHE_DIR, SplitCache, hash_profile
+from choices import ARCHIVE_FORMATS, CROP_BACKENDS, ENGINES
+from memory import MemoryLimit
+
+# pdfminer, PyPDF2 and reportlab are slow to import, so the modules using them are
+# only imported once a command needs them
+if typing.TYPE_CHECKING:
+    import PyPDF2
+
+    import pdf_splitter
+    import question_splitter
+    from manifest import OutputManifest
+    from output import QuestionWriter
+    from source import SourcePDF
+
+
 def fix_click_error():
     import os
 
@@ -5,39 +36,160 @@ def fix_click_error():
     os.environ["LANG"] = "en_US.UTF-8"
 
 
-fix_click_error()
+class DefaultCommandGroup(click.Group):
+    "Command group that runs `split` when no subcommand is given"
 
-import io
-import typing
-from pathlib import Path
+    default_command = "split"
 
-import click
-import PyPDF2
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
+    def parse_args(self, ctx: click.Context, args: list[str]) -> list[str]:
+        if (
+            args
+            and args[0] not in self.commands
+            and args[0] not in ctx.help_option_names
+        ):
+            args = [self.default_command, *args]
+        return super().parse_args(ctx, args)
+
+
+def cache_options(
+    f: typing.Callable[..., typing.Any],
+) -> typing.Callable[..., typing.Any]:
+    "Adds the split cache options to a command, which receives a `cache` argument"
+
+    @click.option(
+        "--cache-dir",
+        default=str(DEFAULT_CACHE_DIR),
+        show_default=True,
+        help="Folder to cache detected questions in.",
+    )
+    @click.option("--no-cache", is_flag=True, help="Always re-parse the input files.")
+    @functools.wraps(f)
+    def wrapper(
+        *args: typing.Any, cache_dir: str, no_cache: bool, **kwargs: typing.Any
+    ):
+        return f(*args, cache=None if no_cache else SplitCache(cache_dir), **kwargs)
+
+    return wrapper
+
+
+def events_option(
+    f: typing.Callable[..., typing.Any],
+) -> typing.Callable[..., typing.Any]:
+    "Adds the --events option to a command, reporting its progress to that sink"
+
+    @click.option(
+        "--events",
+        type=click.Choice(list(instrument.SINKS)),
+        default="summary",
+        show_default=True,
+        help="How progress is reported: a table of the time each file spent in each stage once done, every event as a line of JSON, or nothing.",
+    )
+    @functools.wraps(f)
+    def wrapper(*args: typing.Any, events: str, **kwargs: typing.Any):
+        sink = instrument.SINKS[events]()
+        with instrument.installed(sink):
+            try:
+                return f(*args, **kwargs)
+            finally:
+                sink.close()
+
+    return wrapper
+
+
+def profile_option(
+    f: typing.Callable[..., typing.Any],
+) -> typing.Callable[..., typing.Any]:
+    "Adds the --profile option to a command, which receives a `profile` argument"
+
+    return click.option(
+        "--profile",
+        default=None,
+        help="Folder to save a cProfile of the processing of each file to, as FILE.prof.",
+    )(f)
+
+
+def engine_option(
+    f: typing.Callable[..., typing.Any],
+) -> typing.Callable[..., typing.Any]:
+    "Adds the --engine option to a command, choosing its text extraction engine"
+
+    return click.option(
+        "--engine",
+        type=click.Choice(ENGINES),
+        default="layout",
+        show_default=True,
+        help="Text extraction engine. 'fast' skips pdfminer's layout analysis, and falls back to 'layout' if it finds no questions.",
+    )(f)
+
+
+def crop_backend_option(
+    f: typing.Callable[..., typing.Any],
+) -> typing.Callable[..., typing.Any]:
+    "Adds the --crop-backend option to a command, choosing how pages are cropped"
 
-import pdf_splitter
-import question_splitter
+    return click.option(
+        "--crop-backend",
+        type=click.Choice(CROP_BACKENDS),
+        default="merge",
+        show_default=True,
+        help="How pages are cropped. 'xobject' places each source page as a shared Form XObject, which is faster and makes smaller files.",
+    )(f)
 
 
-def create_textbox_in_page(
-    text: str, location: tuple[float, float], pagesize: tuple[float, float] = A4
-) -> PyPDF2.pdf.PageObject:
-    packet = io.BytesIO()
-    can = canvas.Canvas(packet, pagesize=pagesize)
+def max_memory_option(
+    f: typing.Callable[..., typing.Any],
+) -> typing.Callable[..., typing.Any]:
+    "Adds the --max-memory option to a command, a memory ceiling in MB"
 
-    can.drawString(*location, text)
-    can.save()
+    return click.option(
+        "--max-memory",
+        type=int,
+        default=None,
+        help="Memory ceiling in MB. Parsed pages are released whenever a process goes over it, and re-read as needed. 0 releases them after every page and question.",
+    )(f)
 
-    packet.seek(0)
 
-    new_pdf = PyPDF2.PdfFileReader(packet)
-    text_page: PyPDF2.pdf.PageObject = new_pdf.getPage(0)
+def compress_level_option(
+    f: typing.Callable[..., typing.Any],
+) -> typing.Callable[..., typing.Any]:
+    "Adds the --compress-level option to a command, for compressed PDF 1.5 questions"
 
-    return text_page
+    return click.option(
+        "--compress-level",
+        type=click.IntRange(0, 9),
+        default=None,
+        help="Flate-compress new content streams at this zlib level (0-9), and pack objects into object streams, for smaller PDF 1.5 files.",
+    )(f)
 
 
-@click.command()
+def archive_option(
+    f: typing.Callable[..., typing.Any],
+) -> typing.Callable[..., typing.Any]:
+    "Adds the --archive option to a command, for one archive of questions per file"
+
+    return click.option(
+        "--archive",
+        type=click.Choice(ARCHIVE_FORMATS),
+        default=None,
+        help="Save the questions of each file into one archive (INPUT_NAME.zip or .tar, next to the file or in --output) instead of a folder of files.",
+    )(f)
+
+
+def check_stream_options(stream: bool, line_index: bool, page_jobs: int = 1) -> None:
+    "Rejects what --stream can't do: scanning pages in parallel, or from a line index"
+
+    if stream and page_jobs > 1:
+        raise click.UsageError("--stream can't be combined with --jobs")
+    if stream and line_index:
+        raise click.UsageError("--stream can't be combined with --line-index")
+
+
+@click.group(cls=DefaultCommandGroup)
+def cli():
+    "Split exam papers into individual questions."
+
+
+@cli.command("split")
 @click.argument("input")
 @click.option(
     "--output",
@@ -45,13 +197,785 @@ def create_textbox_in_page(
     help="Folder to output to. Defaults to creating a new folder with the same name as the input file",
 )
 @click.option("--header", default=None, help="The header text of every processed file.")
-def process_file(input: str, output: str, header: str):
-    return extract_questions_from_file(input, output, header)
+@click.option(
+    "--jobs",
+    default=1,
+    show_default=True,
+    help="Number of processes to scan the pages of the file with.",
+)
+@click.option(
+    "--line-index",
+    is_flag=True,
+    help="Save the text lines of each input next to it (as INPUT.lines.json, or INPUT.ENGINE.lines.json for other engines) and search those on later runs.",
+)
+@engine_option
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Write each question as soon as it is found, while the rest of the file is still being scanned. Questions wait until the page layout has been the same for a few pages; any whose crop is changed by a later, differently laid out page are rewritten at the end.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Rewrite every question, even those unchanged since the last run into the same folder.",
+)
+@crop_backend_option
+@max_memory_option
+@compress_level_option
+@archive_option
+@cache_options
+@events_option
+@profile_option
+def process_file(
+    input: str,
+    output: str,
+    header: str,
+    jobs: int,
+    line_index: bool,
+    engine: str,
+    stream: bool,
+    force: bool,
+    crop_backend: str,
+    max_memory: typing.Optional[int],
+    compress_level: typing.Optional[int],
+    archive: typing.Optional[str],
+    cache: typing.Optional[SplitCache],
+    profile: typing.Optional[str],
+):
+    "Process a single PDF file."
+
+    check_stream_options(stream, line_index, jobs)
+
+    return extract_questions_from_file(
+        input,
+        output,
+        header,
+        jobs,
+        cache,
+        line_index,
+        engine,
+        stream,
+        crop_backend,
+        max_memory,
+        force,
+        profile,
+        archive,
+        compress_level,
+    )
+
+
+@cli.command("batch")
+@click.argument("inputs", nargs=-1, required=True)
+@click.option(
+    "--output",
+    default=None,
+    help="Folder to output every file to. Defaults to a new folder next to each input file",
+)
+@click.option("--header", default=None, help="The header text of every processed file.")
+@click.option(
+    "--jobs",
+    default=None,
+    type=int,
+    help="Number of files to process at once. Defaults to the number of CPUs.",
+)
+@click.option(
+    "--line-index",
+    is_flag=True,
+    help="Save the text lines of each input next to it (as INPUT.lines.json, or INPUT.ENGINE.lines.json for other engines) and search those on later runs.",
+)
+@engine_option
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Write each question as soon as it is found, while the rest of the file is still being scanned. Questions wait until the page layout has been the same for a few pages; any whose crop is changed by a later, differently laid out page are rewritten at the end.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Rewrite every question, even those unchanged since the last run into the same folder.",
+)
+@crop_backend_option
+@max_memory_option
+@compress_level_option
+@archive_option
+@cache_options
+@events_option
+@profile_option
+def process_batch(
+    inputs: tuple[str, ...],
+    output: str,
+    header: str,
+    jobs: typing.Optional[int],
+    line_index: bool,
+    engine: str,
+    stream: bool,
+    force: bool,
+    crop_backend: str,
+    max_memory: typing.Optional[int],
+    compress_level: typing.Optional[int],
+    archive: typing.Optional[str],
+    cache: typing.Optional[SplitCache],
+    profile: typing.Optional[str],
+):
+    "Process every PDF in the given files, directories or glob patterns."
+
+    check_stream_options(stream, line_index)
+
+    callback = functools.partial(
+        extract_questions_from_file,
+        output=output,
+        header=header,
+        cache=cache,
+        line_index=line_index,
+        engine=engine,
+        stream=stream,
+        crop_backend=crop_backend,
+        max_memory=max_memory,
+        force=force,
+        profile=profile,
+        archive=archive,
+        compress_level=compress_level,
+    )
+    run_batch(batch.expand_inputs(inputs), callback, jobs)
+
+
+@cli.command("plan")
+@click.argument("inputs", nargs=-1, required=True)
+@click.option(
+    "--output",
+    default=None,
+    help="Folder to save the plans in. Defaults to saving each next to its input, as INPUT.plan.json",
+)
+@click.option(
+    "--jobs",
+    default=None,
+    type=int,
+    help="Number of files to process at once. Defaults to the number of CPUs.",
+)
+@click.option(
+    "--line-index",
+    is_flag=True,
+    help="Save the text lines of each input next to it (as INPUT.lines.json, or INPUT.ENGINE.lines.json for other engines) and search those on later runs.",
+)
+@engine_option
+@cache_options
+@events_option
+def plan_batch(
+    inputs: tuple[str, ...],
+    output: typing.Optional[str],
+    jobs: typing.Optional[int],
+    line_index: bool,
+    engine: str,
+    cache: typing.Optional[SplitCache],
+):
+    """
+    Find the questions in every PDF in the given files, directories or glob
+    patterns, and save where they are without extracting them.
+    """
+
+    callback = functools.partial(
+        save_plan, output=output, cache=cache, line_index=line_index, engine=engine
+    )
+    run_batch(batch.expand_inputs(inputs), callback, jobs)
+
+
+@cli.command("apply")
+@click.argument("plan")
+@click.option(
+    "--input",
+    default=None,
+    help="The planned PDF. Defaults to the file the plan was made from.",
+)
+@click.option(
+    "--output",
+    default=None,
+    help="Folder to output to. Defaults to creating a new folder with the same name as the input file",
+)
+@click.option("--header", default=None, help="The header text of every processed file.")
+@click.option(
+    "--question",
+    "questions",
+    type=int,
+    multiple=True,
+    help="Only extract this question. Can be given several times.",
+)
+@crop_backend_option
+@max_memory_option
+@compress_level_option
+@events_option
+def apply_plan(
+    plan: str,
+    input: typing.Optional[str],
+    output: typing.Optional[str],
+    header: typing.Optional[str],
+    questions: tuple[int, ...],
+    crop_backend: str,
+    max_memory: typing.Optional[int],
+    compress_level: typing.Optional[int],
+):
+    "Extract questions from a PDF using a plan saved by the plan command."
+
+    try:
+        extract_questions_from_plan(
+            plan,
+            input,
+            output,
+            header,
+            questions or None,
+            crop_backend,
+            max_memory,
+            compress_level,
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@cli.command("serve")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8765, show_default=True)
+@click.option(
+    "--root",
+    default=".",
+    show_default=True,
+    help="Folder of the PDFs to serve. Requested paths are relative to it.",
+)
+@click.option(
+    "--max-documents",
+    default=8,
+    show_default=True,
+    help="Number of recently used PDFs to keep open and split.",
+)
+@click.option("--header", default=None, help="The header text of every question.")
+@engine_option
+@crop_backend_option
+@cache_options
+def serve(
+    host: str,
+    port: int,
+    root: str,
+    max_documents: int,
+    header: typing.Optional[str],
+    engine: str,
+    crop_backend: str,
+    cache: typing.Optional[SplitCache],
+):
+    """
+    Serve single questions over HTTP, keeping recently used PDFs open and split.
+
+    GET /question?file=PATH&question=N returns the PDF of one question, and
+    GET /plan?file=PATH the pages of every question in PATH.
+    """
+
+    import server  # imports this module
+
+    documents = server.DocumentCache(
+        max_documents,
+        header=header,
+        crop_backend=crop_backend,
+        engine=engine,
+        cache=cache,
+    )
+    with server.QuestionServer((host, port), root, documents) as httpd:
+        click.echo(f"Serving {Path(root).resolve()} on http://{host}:{port}")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+@cli.command("watch")
+@click.argument(
+    "directories",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--output",
+    default=None,
+    help="Folder to output every file to. Defaults to a new folder next to each input file",
+)
+@click.option("--header", default=None, help="The header text of every processed file.")
+@click.option(
+    "--jobs",
+    default=None,
+    type=int,
+    help="Number of files to process at once. Defaults to the number of CPUs.",
+)
+@engine_option
+@crop_backend_option
+@max_memory_option
+@compress_level_option
+@click.option(
+    "--settle",
+    default=2.0,
+    show_default=True,
+    help="Seconds a new file must stay unchanged before it is processed.",
+)
+@click.option(
+    "--poll",
+    is_flag=True,
+    help="List the directories every few seconds instead of using inotify.",
+)
+@click.option(
+    "--queue-file",
+    default=None,
+    help="File keeping the queue of files still to process across restarts. Defaults to .watch-queue.json in the first directory.",
+)
+@archive_option
+@cache_options
+@events_option
+@profile_option
+def watch_directories(
+    directories: tuple[str, ...],
+    output: typing.Optional[str],
+    header: typing.Optional[str],
+    jobs: typing.Optional[int],
+    engine: str,
+    crop_backend: str,
+    max_memory: typing.Optional[int],
+    settle: float,
+    poll: bool,
+    queue_file: typing.Optional[str],
+    compress_level: typing.Optional[int],
+    archive: typing.Optional[str],
+    cache: typing.Optional[SplitCache],
+    profile: typing.Optional[str],
+):
+    """
+    Split every PDF written into the given directories, until interrupted.
+
+    Files still queued when it stops are processed when it next starts.
+    """
+
+    import watch
+
+    if output and any(Path(output).resolve() == Path(k).resolve() for k in directories):
+        raise click.UsageError("--output can't be one of the watched directories")
+
+    callback = functools.partial(
+        extract_questions_from_file,
+        output=output,
+        header=header,
+        cache=cache,
+        engine=engine,
+        crop_backend=crop_backend,
+        max_memory=max_memory,
+        profile=profile,
+        archive=archive,
+        compress_level=compress_level,
+    )
+    queue = watch.PersistentQueue(
+        queue_file or Path(directories[0]) / ".watch-queue.json"
+    )
+
+    def on_result(result: batch.FileResult):
+        if result.ok:
+            click.echo(f"Split {result.file} ({len(queue)} queued)", err=True)
+        else:
+            click.echo(f"FAILED {result.file}", err=True)
+            click.echo(result.error, err=True)
+
+    if len(queue):
+        click.echo(f"Resuming {len(queue)} queued files", err=True)
+    click.echo(f"Watching {', '.join(directories)}", err=True)
+    try:
+        watch.watch(list(directories), callback, queue, on_result, jobs, settle, poll)
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command("index")
+@click.argument("inputs", nargs=-1, required=True)
+@click.option(
+    "--db",
+    default="questions.db",
+    show_default=True,
+    help="Question bank database to add to.",
+)
+@click.option(
+    "--jobs",
+    default=None,
+    type=int,
+    help="Number of files to process at once. Defaults to the number of CPUs.",
+)
+@engine_option
+def index_batch(
+    inputs: tuple[str, ...], db: str, jobs: typing.Optional[int], engine: str
+):
+    """
+    Add the questions of every PDF in the given files, directories or glob
+    patterns to a question bank database, with their pages and text. Papers that
+    haven't changed since they were last indexed are skipped, and papers that no
+    longer exist are removed.
+    """
+
+    import bank
+
+    question_bank = bank.QuestionBank(db)
+    try:
+        for path in question_bank.remove_missing():
+            click.echo(f"Removed {path}")
+
+        files = batch.expand_inputs(inputs)
+        changed = [k for k in files if not question_bank.is_current(k)]
+        click.echo(f"{len(files) - len(changed)} of {len(files)} files up to date.")
+
+        run_batch(
+            changed,
+            functools.partial(bank.index_paper, engine=engine),
+            jobs,
+            on_success=lambda result: question_bank.add(result.value),
+        )
+    finally:
+        question_bank.close()
+
+
+@cli.command("query")
+@click.option(
+    "--db",
+    default="questions.db",
+    show_default=True,
+    help="Question bank database to search.",
+)
+@click.option(
+    "--question",
+    "questions",
+    type=int,
+    multiple=True,
+    help="Only find questions with this number. Can be given several times.",
+)
+@click.option(
+    "--file",
+    "path_pattern",
+    default=None,
+    help="Only search papers whose absolute path matches this glob pattern.",
+)
+@click.option(
+    "--text",
+    default=None,
+    help="Only find questions containing this text, ignoring case.",
+)
+@click.option(
+    "--extract",
+    default=None,
+    help="Folder to extract every question found to.",
+)
+@click.option("--header", default=None, help="The header text of every question.")
+@crop_backend_option
+def query_bank(
+    db: str,
+    questions: tuple[int, ...],
+    path_pattern: typing.Optional[str],
+    text: typing.Optional[str],
+    extract: typing.Optional[str],
+    header: typing.Optional[str],
+    crop_backend: str,
+):
+    "Find questions in a question bank database, and optionally extract them."
+
+    import bank
+
+    question_bank = bank.QuestionBank(db)
+    try:
+        results = question_bank.query(questions, path_pattern, text)
+    finally:
+        question_bank.close()
+
+    for question in results:
+        first, last = question.pages[0].page + 1, question.pages[-1].page + 1
+        pages = f"page {first}" if first == last else f"pages {first}-{last}"
+        click.echo(f"{question.path}  Q{question.number}  {pages}")
+    click.echo(f"{len(results)} questions found.")
+
+    if extract:
+        for plan in bank.QuestionBank.plans(results):
+            try:
+                extract_planned_questions(
+                    plan, output=extract, header=header, crop_backend=crop_backend
+                )
+            except (OSError, ValueError) as e:
+                click.echo(f"Skipped {plan.file}: {e}", err=True)
+
+
+def run_batch(
+    files: list[str],
+    callback: typing.Callable[[str], typing.Any],
+    jobs: typing.Optional[int],
+    on_success: typing.Optional[typing.Callable[[batch.FileResult], None]] = None,
+):
+    """
+    Runs `callback` on every file, echoing each result and exiting with 1 on
+    failures. `on_success` is called in this process with each successful result.
+    Progress goes to stderr, leaving stdout to the events of the files.
+    """
+
+    failures = 0
+    for idx, result in enumerate(batch.process_files(files, callback, jobs)):
+        if result.ok:
+            if on_success:
+                on_success(result)
+            click.echo(f"[{idx + 1}/{len(files)}] {result.file}", err=True)
+        else:
+            failures += 1
+            click.echo(f"[{idx + 1}/{len(files)}] FAILED {result.file}", err=True)
+            click.echo(result.error, err=True)
+
+    if failures:
+        click.echo(f"{failures} of {len(files)} files failed.", err=True)
+        sys.exit(1)
+
+
+@cli.command("search")
+@click.argument("input")
+@click.argument("regex")
+@click.option("--ignore-case/--match-case", default=True, show_default=True)
+def search_file(input: str, regex: str, ignore_case: bool):
+    """
+    Search the text lines of INPUT for REGEX, for trying out new label patterns.
+
+    Uses (and creates on first use) the INPUT.lines.json line index, so repeated
+    searches don't re-process the PDF.
+    """
+
+    import file_parser
+
+    pattern = re.compile(regex, re.IGNORECASE if ignore_case else 0)
+    index = file_parser.load_or_build_index(input)
+
+    click.echo("page x1  y1  x2  y2   text")
+    for line in index.lines:
+        if pattern.search(line.text):
+            bbox = "".join(f"{i:<4.0f}" for i in (line.x1, line.y1, line.x2, line.y2))
+            click.echo(f"{line.page:<5}{bbox} {line.text}")
+
+
+def build_question(
+    cropper: "pdf_splitter.PageCropper",
+    question: int,
+    pages: "list[question_splitter.PageData]",
+) -> "PyPDF2.PdfFileWriter":
+    import PyPDF2
+
+    import pdf_splitter
+
+    start = time.perf_counter()
+    output_pdf = PyPDF2.PdfFileWriter()
+    deduplicator = pdf_splitter.ResourceDeduplicator()
+    for page_data in pages:
+        # deduping reads the fonts of the input, which writers of earlier questions
+        # may be reading on other threads
+        with cropper.lock:
+            new_page = cropper.crop(page_data.page, page_data.viewport)
+            deduplicator.dedupe(new_page)
+
+        output_pdf.addPage(new_page)
+
+    instrument.emit(
+        "question",
+        stage="crop",
+        question=question,
+        page=pages[0].page if pages else None,
+        duration=time.perf_counter() - start,
+    )
+    return output_pdf
 
 
 def extract_questions_from_file(
-    input: str, output: typing.Optional[str] = None, header: typing.Optional[str] = None
+    input: str,
+    output: typing.Optional[str] = None,
+    header: typing.Optional[str] = None,
+    jobs: int = 1,
+    cache: typing.Optional[SplitCache] = None,
+    line_index: bool = False,
+    engine: str = "layout",
+    stream: bool = False,
+    crop_backend: str = "merge",
+    max_memory: typing.Optional[int] = None,
+    force: bool = False,
+    profile: typing.Optional[str] = None,
+    archive: typing.Optional[str] = None,
+    compress_level: typing.Optional[int] = None,
+):
+    import pdf_splitter
+    import question_splitter
+    from manifest import OutputManifest
+    from output import ArchiveOutput, FolderOutput, QuestionWriter
+    from source import SourcePDF
+
+    header = header or Path(input).stem
+    text_page = pdf_splitter.create_textbox_in_page(header, location=(55, 790))
+
+    cropper_class = pdf_splitter.CROPPERS[crop_backend]
+    memory_limit = MemoryLimit.megabytes(max_memory)
+
+    # read the input once, for both finding and cropping the questions
+    with instrument.processing(input, profile), SourcePDF(input) as source:
+        manifest = None
+        if archive:
+            # the archive is rewritten whole, so there's nothing to skip
+            _filename = question_paths(input, archive=True)
+            destination = ArchiveOutput(archive_path(input, output, archive), archive)
+        else:
+            _filename = question_paths(input, output)
+            destination = FolderOutput()
+            manifest = OutputManifest(
+                output_folder(input, output),
+                Path(input).stem,
+                [
+                    source.sha256,
+                    header,
+                    crop_backend,
+                    hash_profile(question_splitter.SEARCH_PATTERNS),
+                    str(compress_level),
+                ],
+            )
+            if force:
+                manifest.forget()
+
+        with QuestionWriter(
+            destination,
+            pdf_splitter.reader_lock(source.reader),
+            compress_level=compress_level,
+        ) as writer:
+            if stream:
+                _extract_streaming(
+                    source,
+                    cropper_class,
+                    text_page,
+                    _filename,
+                    writer,
+                    cache,
+                    engine,
+                    memory_limit,
+                    manifest,
+                )
+            else:
+                # process PDF
+                results = question_splitter.split_question(
+                    source,
+                    workers=jobs,
+                    cache=cache,
+                    use_index=line_index,
+                    engine=engine,
+                    memory_limit=memory_limit,
+                )
+                write_questions(
+                    cropper_class(source.reader, text_page),
+                    results,
+                    _filename,
+                    writer,
+                    memory_limit,
+                    manifest,
+                )
+
+        if manifest:
+            for path in manifest.finish():
+                instrument.emit("message", message=f"Removed {path}")
+
+
+def extract_questions_from_plan(
+    plan_file: str,
+    input: typing.Optional[str] = None,
+    output: typing.Optional[str] = None,
+    header: typing.Optional[str] = None,
+    questions: typing.Optional[typing.Iterable[int]] = None,
+    crop_backend: str = "merge",
+    max_memory: typing.Optional[int] = None,
+    compress_level: typing.Optional[int] = None,
+):
+    "Extracts the questions of a saved plan, or only the given ones"
+
+    import question_splitter
+
+    extract_planned_questions(
+        question_splitter.QuestionPlan.load(plan_file),
+        input,
+        output,
+        header,
+        questions,
+        crop_backend,
+        max_memory,
+        compress_level,
+    )
+
+
+def extract_planned_questions(
+    plan: "question_splitter.QuestionPlan",
+    input: typing.Optional[str] = None,
+    output: typing.Optional[str] = None,
+    header: typing.Optional[str] = None,
+    questions: typing.Optional[typing.Iterable[int]] = None,
+    crop_backend: str = "merge",
+    max_memory: typing.Optional[int] = None,
+    compress_level: typing.Optional[int] = None,
 ):
+    "Extracts the questions of a plan from its file, or `input`"
+
+    import pdf_splitter
+    from output import FolderOutput, QuestionWriter
+    from source import SourcePDF
+
+    input = input or plan.file
+
+    selected = plan.questions
+    if questions is not None:
+        if missing := sorted(set(questions) - set(plan.questions)):
+            raise ValueError(f"Questions {missing} aren't in the plan of {plan.file}")
+        selected = {k: plan.questions[k] for k in questions}
+
+    with instrument.processing(input), SourcePDF(input) as source:
+        if source.sha256 != plan.sha256:
+            raise ValueError(f"{input} has changed since it was planned")
+
+        text_page = pdf_splitter.create_textbox_in_page(
+            header or Path(input).stem, location=(55, 790)
+        )
+        cropper = pdf_splitter.CROPPERS[crop_backend](source.reader, text_page)
+        with QuestionWriter(
+            FolderOutput(), cropper.lock, compress_level=compress_level
+        ) as writer:
+            write_questions(
+                cropper,
+                selected,
+                question_paths(input, output),
+                writer,
+                MemoryLimit.megabytes(max_memory),
+            )
+
+
+def save_plan(
+    input: str,
+    output: typing.Optional[str] = None,
+    jobs: int = 1,
+    cache: typing.Optional[SplitCache] = None,
+    line_index: bool = False,
+    engine: str = "layout",
+) -> Path:
+    "Finds the questions of a file and saves them as a plan, returning its path"
+
+    import question_splitter
+    from source import SourcePDF
+
+    with instrument.processing(input), SourcePDF(input) as source:
+        questions = question_splitter.split_question(
+            source, workers=jobs, cache=cache, use_index=line_index, engine=engine
+        )
+        plan = question_splitter.QuestionPlan(
+            str(Path(input).resolve()), source.sha256, questions
+        )
+
+    path = question_splitter.QuestionPlan.sidecar_path(input)
+    if output:
+        Path(output).mkdir(exist_ok=True)
+        path = Path(output) / path.name
+    plan.save(path)
+    return path
+
+
+def output_folder(input: str, output: typing.Optional[str] = None) -> Path:
+    "Creates the folder to output the questions of a file to"
+
     path = Path(input)
 
     # create folder
@@ -62,28 +986,107 @@ def extract_questions_from_file(
         parent = path.parent
         folder = parent / path.stem
         folder.mkdir(exist_ok=True)
+    return folder
+
+
+def archive_path(input: str, output: typing.Optional[str], format: str) -> Path:
+    "The path of the archive of the questions of a file, next to it or in `output`"
+
+    path = Path(input)
+    folder = Path(output) if output else path.parent
+    folder.mkdir(exist_ok=True)
+    return folder / f"{path.stem}.{format}"
+
+
+def question_paths(
+    input: str, output: typing.Optional[str] = None, archive: bool = False
+) -> typing.Callable[[int], Path]:
+    """
+    Creates the output folder of a file, returning the path of each question in it.
+    Questions saved into an archive are named the same, without a folder.
+    """
+
+    path = Path(input)
+    folder = Path() if archive else output_folder(input, output)
+
+    def _filename(question: int) -> Path:
+        return folder / (f"{question} ({path.stem}).pdf")
+
+    return _filename
+
+
+def write_questions(
+    cropper: "pdf_splitter.PageCropper",
+    questions: "typing.Mapping[int, list[question_splitter.PageData]]",
+    filename: typing.Callable[[int], Path],
+    writer: "QuestionWriter",
+    memory_limit: typing.Optional[MemoryLimit] = None,
+    manifest: typing.Optional["OutputManifest"] = None,
+):
+    "Crops every question for `writer` to save, skipping those the manifest has up to date"
+
+    for question, pages in questions.items():
+        path = filename(question)
+        if manifest and not manifest.needs_writing(path, pages):
+            continue
+
+        writer.submit(path, question, build_question(cropper, question, pages))
+        if memory_limit:
+            memory_limit.check(cropper.release)
+
+
+def _extract_streaming(
+    source: "SourcePDF",
+    cropper_class: "type[pdf_splitter.PageCropper]",
+    text_page: "PyPDF2.pdf.PageObject",
+    filename: typing.Callable[[int], Path],
+    writer: "QuestionWriter",
+    cache: typing.Optional[SplitCache],
+    engine: str,
+    memory_limit: typing.Optional[MemoryLimit],
+    manifest: typing.Optional["OutputManifest"] = None,
+):
+    "Crops each question on another thread as soon as the splitter finds it"
 
-    text_page = create_textbox_in_page(header or path.stem, location=(55, 790))
+    import question_splitter
 
-    # process PDF
-    results = question_splitter.split_question(input)
-    input_PDF = PyPDF2.PdfFileReader(input)
+    questions: queue.Queue[
+        typing.Optional[tuple[int, list[question_splitter.PageData]]]
+    ] = queue.Queue(maxsize=4)
+    errors: list[BaseException] = []
 
-    for question, pages in results.items():
-        output_pdf = PyPDF2.PdfFileWriter()
-        for page_data in pages:
-            print(question, page_data)
-            p: PyPDF2.pdf.PageObject = input_PDF.getPage(page_data.page)
-            new_page = pdf_splitter.extract_viewport(p, page_data.viewport)
+    def _cropper():
+        cropper = cropper_class(source.reader, text_page)
+        while item := questions.get():
+            if errors:
+                continue  # keep draining so the splitter never blocks
+            try:
+                write_questions(
+                    cropper, dict([item]), filename, writer, memory_limit, manifest
+                )
+            except BaseException as e:
+                errors.append(e)
 
-            new_page.mergePage(text_page)
+    # the cropper's events belong to the same file as the splitter's
+    thread = threading.Thread(
+        target=contextvars.copy_context().run, args=(_cropper,), name="question-cropper"
+    )
+    thread.start()
+    try:
+        for item in question_splitter.iter_split_question(
+            source, cache=cache, engine=engine, memory_limit=memory_limit
+        ):
+            questions.put(item)
+    finally:
+        questions.put(None)
+        thread.join()
 
-            output_pdf.addPage(new_page)
-        with open(folder / (f"{question} ({path.stem}).pdf"), "wb") as f:
-            output_pdf.write(f)
+    if errors:
+        raise errors[0]
 
 
 if __name__ == "__main__":
-    # process_file()
+    fix_click_error()
+    multiprocessing.freeze_support()
     # gui()
-    process_file()
+    cli()
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import typing
+from pathlib import Path
+
+from atomic import write_atomically
+from question_splitter import PageData
+
+
+def pages_digest(pages: list[PageData]) -> str:
+    "SHA-256 of the pages and viewports of a question"
+
+    return hashlib.sha256(
+        json.dumps([[k.page, k.viewport.y1, k.viewport.y2] for k in pages]).encode()
+    ).hexdigest()
+
+
+class OutputManifest:
+    """
+    Records what the question files of one input in an output folder were made
+    from, in a hidden file next to them. A re-run only rewrites the questions whose
+    pages, input or options have changed, and removes the questions that are gone.
+
+    Only files listed in a previous manifest are ever removed.
+    """
+
+    VERSION: typing.ClassVar[int] = 1
+
+    path: Path
+    options: str  # hash of the input file and everything else shared by its questions
+
+    def __init__(self, folder: Path, stem: str, options: typing.Iterable[str]):
+        self.path = folder / f".{stem}.manifest.json"
+        self.options = hashlib.sha256(
+            "\0".join([str(self.VERSION), *options]).encode()
+        ).hexdigest()
+
+        self._previous: dict[str, str] = {}  # file name: pages digest
+        self._current: dict[str, str] = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            self._previous = data["questions"]
+            if data["options"] != self.options:
+                self.forget()
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def forget(self) -> None:
+        "Treats every question as out of date, while still removing stale ones"
+
+        self._previous = dict.fromkeys(self._previous, "")
+
+    def needs_writing(self, filename: Path, pages: list[PageData]) -> bool:
+        "Records a question, returning whether its file is missing or out of date"
+
+        digest = pages_digest(pages)
+        # a question yielded twice while streaming was already written once this run
+        on_disk = self._current.get(filename.name, self._previous.get(filename.name))
+        self._current[filename.name] = digest
+        return on_disk != digest or not filename.exists()
+
+    def finish(self) -> list[Path]:
+        """
+        Removes the files of questions that weren't recorded this time, and saves
+        the manifest. Returns the removed files.
+        """
+
+        removed = []
+        for name in self._previous.keys() - self._current.keys():
+            stale = self.path.parent / name
+            if stale.exists():
+                stale.unlink()
+                removed.append(stale)
+
+        data = {"options": self.options, "questions": self._current}
+        write_atomically(self.path, json.dumps(data, separators=(",", ":")).encode())
+
+        return removed
@@ -0,0 +1,43 @@
+import gc
+import os
+import typing
+from dataclasses import dataclass
+
+
+def resident_memory() -> typing.Optional[int]:
+    "Resident set size of this process in bytes, or None where it can't be read"
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+@dataclass(frozen=True)
+class MemoryLimit:
+    """
+    Ceiling on the resident memory of a process. Whatever holds parsed PDF objects
+    releases them whenever it is over the ceiling, and re-reads them from the file
+    as they're needed again. A ceiling of 0 (or one that can't be measured on this
+    platform) releases them every time.
+    """
+
+    max_bytes: int
+
+    @classmethod
+    def megabytes(cls, size: typing.Optional[int]) -> typing.Optional["MemoryLimit"]:
+        return None if size is None else cls(size * 1024 * 1024)
+
+    def exceeded(self) -> bool:
+        if self.max_bytes <= 0:
+            return True
+        rss = resident_memory()
+        return rss is None or rss > self.max_bytes
+
+    def check(self, release: typing.Callable[[], None]) -> None:
+        "Calls `release` if over the ceiling"
+
+        if self.exceeded():
+            release()
+            gc.collect()  # parsed objects refer to each other
@@ -0,0 +1,254 @@
+import concurrent.futures
+import contextvars
+import io
+import os
+import tarfile
+import threading
+import time
+import typing
+import zipfile
+from pathlib import Path
+
+import instrument
+from atomic import create_temporary, write_atomically
+
+if typing.TYPE_CHECKING:
+    import PyPDF2
+
+
+class FolderOutput:
+    "Saves each question as a file of its own"
+
+    def write(self, path: Path, data: bytes) -> None:
+        write_atomically(path, data)
+
+    def close(self) -> None:
+        pass
+
+    def discard(self) -> None:
+        pass
+
+
+class ArchiveOutput:
+    """
+    Saves every question into a single ZIP or tar archive at `path`. Questions are
+    added to a temporary archive as they're saved, which replaces `path` once
+    closed. One big file is much quicker to create than many small ones on network
+    shares.
+    """
+
+    def __init__(self, path: Path, format: str = "zip"):
+        self.path = path
+        self.format = format
+
+        # the temporary archive is only created once used, so an output that is
+        # never written to leaves nothing behind
+        self._temp_name = ""
+        self._file: typing.Optional[typing.BinaryIO] = None
+        self._archive: typing.Optional[typing.Union[zipfile.ZipFile, tarfile.TarFile]]
+        self._archive = None
+        # entry holding the latest data of each file
+        self._entries: dict[str, str] = {}
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def write(self, path: Path, data: bytes) -> None:
+        with self._lock:
+            # archives can't replace entries, so a file saved again is added under
+            # another name, and close() keeps only the latest
+            entry = path.name
+            if entry in self._entries:
+                entry = f".replaced/{self._added}/{path.name}"
+            self._add(self._start(), entry, data)
+            self._entries[path.name] = entry
+            self._added += 1
+
+    def close(self) -> None:
+        with self._lock:
+            self._start()  # an empty archive, if nothing was written
+            try:
+                self._close_temporary()
+                if any(k != v for k, v in self._entries.items()):
+                    self._rebuild()
+                os.replace(self._temp_name, self.path)
+            except BaseException:
+                os.unlink(self._temp_name)
+                raise
+
+    def discard(self) -> None:
+        "Deletes the temporary archive, leaving `path` as it was"
+
+        with self._lock:
+            if not self._temp_name:
+                return
+            try:
+                self._close_temporary()
+            finally:
+                os.unlink(self._temp_name)
+
+    def _start(self) -> typing.Union[zipfile.ZipFile, tarfile.TarFile]:
+        "The temporary archive, created next to `path` on first use"
+
+        if self._archive is None:
+            fd, self._temp_name = create_temporary(self.path)
+            self._file = os.fdopen(fd, "w+b")
+            self._archive = self._open(self._file, "w")
+        return self._archive
+
+    def _close_temporary(self) -> None:
+        if self._archive is not None:
+            self._archive.close()
+        if self._file is not None:
+            self._file.close()
+
+    def _rebuild(self) -> None:
+        "Rewrites the temporary archive with only the latest entry of each file"
+
+        fd, temp_name = create_temporary(self.path)
+        try:
+            with os.fdopen(fd, "w+b") as f, open(self._temp_name, "rb") as source:
+                with self._open(source, "r") as old, self._open(f, "w") as new:
+                    for name, entry in self._entries.items():
+                        self._add(new, name, self._read(old, entry))
+            os.replace(temp_name, self._temp_name)
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+
+    def _open(
+        self, file: typing.BinaryIO, mode: str
+    ) -> typing.Union[zipfile.ZipFile, tarfile.TarFile]:
+        if self.format == "zip":
+            return zipfile.ZipFile(file, mode, zipfile.ZIP_DEFLATED)  # type: ignore
+        return tarfile.open(fileobj=file, mode=mode)  # type: ignore
+
+    @staticmethod
+    def _add(
+        archive: typing.Union[zipfile.ZipFile, tarfile.TarFile], name: str, data: bytes
+    ) -> None:
+        if isinstance(archive, zipfile.ZipFile):
+            archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(data))
+
+    @staticmethod
+    def _read(
+        archive: typing.Union[zipfile.ZipFile, tarfile.TarFile], name: str
+    ) -> bytes:
+        if isinstance(archive, zipfile.ZipFile):
+            return archive.read(name)
+        return typing.cast(typing.IO[bytes], archive.extractfile(name)).read()
+
+
+Output = typing.Union[FolderOutput, ArchiveOutput]
+
+
+class QuestionWriter:
+    """
+    Serializes and saves questions on a thread pool, so disk and network I/O is off
+    the critical path of cropping the next question. At most `max_pending`
+    questions are held at once; submitting more waits for one to be saved.
+
+    PyPDF2 writers read the objects of the input, and rewrite their references in
+    place, so serializing happens under `lock`, which croppers of the same input
+    must hold too. With a `compress_level`, questions are saved as compressed PDF
+    1.5 files (see pdf_compress), and only gathering their objects needs the lock.
+    """
+
+    def __init__(
+        self,
+        output: Output,
+        lock: typing.ContextManager[typing.Any],
+        workers: int = 4,
+        max_pending: int = 8,
+        compress_level: typing.Optional[int] = None,
+    ):
+        self.output = output
+        self.lock = lock
+        self.compress_level = compress_level
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="question-writer"
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending: dict[Path, concurrent.futures.Future[None]] = {}
+        self._errors: list[BaseException] = []
+        self._state_lock = threading.Lock()
+
+    def __enter__(self) -> "QuestionWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
+            self.output.discard()
+
+    def submit(self, path: Path, question: int, pdf: "PyPDF2.PdfFileWriter") -> None:
+        "Queues `pdf` to be saved as `path`, after any earlier write of it"
+
+        self._raise_error()
+        with self._state_lock:
+            previous = self._pending.get(path)
+        if previous:
+            concurrent.futures.wait([previous])
+
+        self._slots.acquire()
+        # the events of the write belong to the file being processed
+        future = self._executor.submit(
+            contextvars.copy_context().run, self._write, path, question, pdf
+        )
+        with self._state_lock:
+            self._pending[path] = future
+        future.add_done_callback(lambda done: self._finished(path, done))
+
+    def close(self) -> None:
+        "Waits for every question to be saved, then finishes the output"
+
+        self._executor.shutdown(wait=True)
+        try:
+            self._raise_error()
+        except BaseException:
+            self.output.discard()
+            raise
+        self.output.close()
+
+    def _write(self, path: Path, question: int, pdf: "PyPDF2.PdfFileWriter") -> None:
+        start = time.perf_counter()
+        buffer = io.BytesIO()
+        if self.compress_level is None:
+            with self.lock:
+                pdf.write(buffer)
+        else:
+            import pdf_compress
+
+            with self.lock:
+                serialized = pdf_compress.serialize(pdf)
+            # zlib releases the GIL, so questions compress in parallel on the pool
+            serialized.write(buffer, self.compress_level)
+        data = buffer.getvalue()
+        self.output.write(path, data)
+
+        instrument.emit(
+            "question",
+            stage="write",
+            question=question,
+            duration=time.perf_counter() - start,
+            bytes=len(data),
+        )
+
+    def _finished(self, path: Path, future: concurrent.futures.Future[None]) -> None:
+        self._slots.release()
+        with self._state_lock:
+            if self._pending.get(path) is future:
+                del self._pending[path]
+            if future.exception():
+                self._errors.append(typing.cast(BaseException, future.exception()))
+
+    def _raise_error(self) -> None:
+        with self._state_lock:
+            if self._errors:
+                raise self._errors[0]
@@ -0,0 +1,159 @@
+import io
+import typing
+import zlib
+from dataclasses import dataclass
+
+from PyPDF2 import PdfFileWriter
+from PyPDF2.generic import IndirectObject, StreamObject
+from PyPDF2.pdf import PageObject
+
+OBJECTS_PER_STREAM = 100
+
+# object streams and cross-reference streams need PDF 1.5; the comment marks the
+# file as binary
+HEADER = b"%PDF-1.5\n%\xe2\xe3\xcf\xd3\n"
+
+
+@dataclass
+class SerializedObject:
+    data: bytes  # the object, or the dictionary entries of a stream
+    stream: typing.Optional[bytes] = None
+    filtered: bool = False  # whether the stream is already encoded
+
+
+@dataclass
+class SerializedPDF:
+    "The objects of a PdfFileWriter as bytes, to be compressed and written without it"
+
+    objects: list[SerializedObject]  # numbered from 1
+    trailer: bytes  # the /Root, /Info and /ID entries
+
+    def write(
+        self, stream: typing.BinaryIO, level: int = zlib.Z_DEFAULT_COMPRESSION
+    ) -> None:
+        """
+        Writes the PDF with every unencoded stream Flate-compressed at `level`, and
+        every other object packed into compressed object streams, listed by a
+        cross-reference stream.
+        """
+
+        stream.write(HEADER)
+
+        # (type, offset or object stream, generation or index) of each object
+        entries = [(0, 0, 0xFFFF)] * (len(self.objects) + 1)
+        packed = []
+        for number, obj in enumerate(self.objects, 1):
+            if obj.stream is None:
+                packed.append(number)
+                continue
+
+            entries[number] = (1, stream.tell(), 0)
+            if obj.filtered:
+                write_stream(stream, number, obj.data, obj.stream)
+            else:
+                write_stream(
+                    stream,
+                    number,
+                    obj.data + b"/Filter /FlateDecode\n",
+                    zlib.compress(obj.stream, level),
+                )
+
+        number = len(self.objects) + 1
+        for start in range(0, len(packed), OBJECTS_PER_STREAM):
+            chunk = packed[start : start + OBJECTS_PER_STREAM]
+            offsets, body = [], io.BytesIO()
+            for index, packed_number in enumerate(chunk):
+                offsets.append(b"%d %d" % (packed_number, body.tell()))
+                body.write(self.objects[packed_number - 1].data + b"\n")
+                entries[packed_number] = (2, number, index)
+
+            header = b" ".join(offsets) + b"\n"
+            entries.append((1, stream.tell(), 0))
+            write_stream(
+                stream,
+                number,
+                b"/Type /ObjStm\n/N %d\n/First %d\n/Filter /FlateDecode\n"
+                % (len(chunk), len(header)),
+                zlib.compress(header + body.getvalue(), level),
+            )
+            number += 1
+
+        # the cross-reference stream lists itself too
+        xref = stream.tell()
+        entries.append((1, xref, 0))
+        width = max(1, (max(k[1] for k in entries).bit_length() + 7) // 8)
+        table = b"".join(
+            bytes([kind]) + field.to_bytes(width, "big") + extra.to_bytes(2, "big")
+            for kind, field, extra in entries
+        )
+        write_stream(
+            stream,
+            number,
+            b"/Type /XRef\n/Size %d\n/W [1 %d 2]\n" % (len(entries), width)
+            + self.trailer
+            + b"/Filter /FlateDecode\n",
+            zlib.compress(table, level),
+        )
+        stream.write(b"startxref\n%d\n%%%%EOF\n" % xref)
+
+
+def write_stream(
+    stream: typing.BinaryIO, number: int, entries: bytes, data: bytes
+) -> None:
+    stream.write(
+        b"%d 0 obj\n<<\n%s/Length %d\n>>\nstream\n" % (number, entries, len(data))
+    )
+    stream.write(data)
+    stream.write(b"\nendstream\nendobj\n")
+
+
+def serialize(pdf: PdfFileWriter) -> SerializedPDF:
+    """
+    Gathers every object `pdf` uses, as PdfFileWriter.write does, and serializes
+    them. Like writing, this reads the objects of the input and rewrites their
+    references in place; compressing the result needs neither.
+    """
+
+    if hasattr(pdf, "_encrypt"):
+        raise ValueError("Encrypted PDFs can't be compressed")
+
+    if not pdf._root:
+        pdf._root = pdf._addObject(pdf._root_object)
+
+    # copied from PdfFileWriter.write, so pages referring to themselves keep
+    # pointing at their copy in this PDF
+    external: dict[typing.Any, dict[int, dict[int, IndirectObject]]] = {}
+    for index, obj in enumerate(pdf._objects):
+        if isinstance(obj, PageObject) and obj.indirectRef is not None:
+            ref = obj.indirectRef
+            external.setdefault(ref.pdf, {}).setdefault(ref.generation, {})[
+                ref.idnum
+            ] = IndirectObject(index + 1, 0, pdf)
+
+    pdf.stack = []
+    pdf._sweepIndirectReferences(external, pdf._root)
+    del pdf.stack
+
+    objects = []
+    for obj in pdf._objects:
+        data = io.BytesIO()
+        if isinstance(obj, StreamObject):
+            for key, value in obj.items():
+                if key != "/Length":
+                    key.writeToStream(data, None)
+                    data.write(b" ")
+                    value.writeToStream(data, None)
+                    data.write(b"\n")
+            objects.append(
+                SerializedObject(data.getvalue(), obj._data, "/Filter" in obj)
+            )
+        else:
+            obj.writeToStream(data, None)
+            objects.append(SerializedObject(data.getvalue()))
+
+    trailer = b"/Root %d 0 R\n/Info %d 0 R\n" % (pdf._root.idnum, pdf._info.idnum)
+    if hasattr(pdf, "_ID"):
+        data = io.BytesIO()
+        pdf._ID.writeToStream(data, None)
+        trailer += b"/ID " + data.getvalue() + b"\n"
+    return SerializedPDF(objects, trailer)
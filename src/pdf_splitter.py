@@ -1,11 +1,106 @@
+import collections
 import copy
+import functools
+import hashlib
+import threading
+import typing
+import weakref
+from dataclasses import dataclass
 
-from PyPDF2.pdf import PageObject
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    FloatObject,
+    IndirectObject,
+    NameObject,
+    RectangleObject,
+    StreamObject,
+)
+from PyPDF2.pdf import ContentStream, PageObject
 
 from question_splitter import Viewport
 
 __import__("pypdf2_patch").patch()
 
+_reader_locks: "weakref.WeakKeyDictionary[PdfFileReader, threading.RLock]" = (
+    weakref.WeakKeyDictionary()
+)
+_reader_locks_guard = threading.Lock()
+
+
+def reader_lock(reader: PdfFileReader) -> "threading.RLock":
+    """
+    The lock to hold while using the objects of `reader` on several threads. PyPDF2
+    isn't thread safe: reading objects caches them in the reader, and writing them
+    out rewrites their references in place.
+    """
+
+    with _reader_locks_guard:
+        lock = _reader_locks.get(reader)
+        if lock is None:
+            lock = _reader_locks[reader] = threading.RLock()
+        return lock
+
+
+# A4 in points, as reportlab has it
+A4 = (595.2756, 841.8898)
+
+
+def format_number(value: float) -> bytes:
+    return f"{value:.4f}".rstrip("0").rstrip(".").encode()
+
+
+@functools.lru_cache(maxsize=256)
+def textbox_content(text: str, location: tuple[float, float]) -> bytes:
+    "Content stream drawing one line of 12pt Helvetica, as reportlab's drawString"
+
+    # Helvetica is a standard font, so only WinAnsi characters can be shown
+    escaped = (
+        text.encode("cp1252", "replace")
+        .replace(b"\\", b"\\\\")
+        .replace(b"(", b"\\(")
+        .replace(b")", b"\\)")
+    )
+    x, y = map(format_number, location)
+    return b"BT /F1 12 Tf 1 0 0 1 %s %s Tm (%s) Tj ET" % (x, y, escaped)
+
+
+def create_textbox_in_page(
+    text: str,
+    location: tuple[float, float],
+    page_size: tuple[float, float] = A4,
+) -> PageObject:
+    """
+    A blank page with one line of text on it, for croppers to overlay as a header.
+    The page is written out directly, without drawing it with reportlab.
+    """
+
+    page = PageObject.createBlankPage(width=page_size[0], height=page_size[1])
+
+    content = DecodedStreamObject()
+    content.setData(textbox_content(text, tuple(location)))
+    page[NameObject("/Contents")] = content
+    page[NameObject("/Resources")] = DictionaryObject(
+        {
+            NameObject("/Font"): DictionaryObject(
+                {
+                    NameObject("/F1"): DictionaryObject(
+                        {
+                            NameObject("/Type"): NameObject("/Font"),
+                            NameObject("/Subtype"): NameObject("/Type1"),
+                            NameObject("/BaseFont"): NameObject("/Helvetica"),
+                            NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+                        }
+                    )
+                }
+            )
+        }
+    )
+    return page
+
 
 def copy_PageObject(page: PageObject) -> PageObject:
     "Makes a shallow copy of a PageObject, ready for cropping"
@@ -33,3 +128,402 @@ def extract_viewport(
     new_page.mergePage(trimmed_page)
 
     return new_page
+
+
+RESOURCE_TYPES = (
+    "/ExtGState",
+    "/Font",
+    "/XObject",
+    "/ColorSpace",
+    "/Pattern",
+    "/Shading",
+    "/Properties",
+)
+
+# operators with operands naming a resource, and the type of resource they name
+RESOURCE_OPERATORS = {
+    b"Tf": "/Font",
+    b"Do": "/XObject",
+    b"gs": "/ExtGState",
+    b"cs": "/ColorSpace",
+    b"CS": "/ColorSpace",
+    b"scn": "/Pattern",
+    b"SCN": "/Pattern",
+    b"sh": "/Shading",
+    b"BDC": "/Properties",
+    b"DP": "/Properties",
+}
+
+Operation = tuple[list[typing.Any], typing.Union[str, bytes]]
+
+
+def parse_operations(page: PageObject) -> list[Operation]:
+    "Parses the content stream(s) of a page into a list of (operands, operator)"
+
+    contents = page.getContents()
+    if contents is None:
+        return []
+    return ContentStream(contents, page.pdf).operations
+
+
+def rename_operations(
+    operations: list[Operation], rename: typing.Mapping[str, str]
+) -> list[Operation]:
+    "Copy of `operations` with resource names renamed, leaving the original intact"
+
+    if not rename:
+        return operations
+    return [
+        (
+            (
+                [rename.get(k, k) if isinstance(k, NameObject) else k for k in operands]
+                if isinstance(operands, list)
+                else operands
+            ),  # inline images
+            operator,
+        )
+        for operands, operator in operations
+    ]
+
+
+def clip_operations(box: RectangleObject) -> list[Operation]:
+    "Operations clipping everything after them to `box`, as the patched mergePage does"
+
+    return [
+        (
+            [
+                FloatObject(box.getLowerLeft_x()),
+                FloatObject(box.getLowerLeft_y()),
+                FloatObject(box.getWidth()),
+                FloatObject(box.getHeight()),
+            ],
+            "re",
+        ),
+        ([], "W"),
+        ([], "n"),
+    ]
+
+
+def used_resources(operations: list[Operation]) -> dict[str, set[str]]:
+    "The names of the resources used by `operations`, by resource type"
+
+    used: dict[str, set[str]] = collections.defaultdict(set)
+    for operands, operator in operations:
+        if isinstance(operator, str):
+            operator = operator.encode()
+
+        if operator == b"INLINE IMAGE":
+            settings = operands["settings"]
+            colour_space = settings.get("/CS", settings.get("/ColorSpace"))
+            if isinstance(colour_space, NameObject):
+                used["/ColorSpace"].add(colour_space)
+        elif res := RESOURCE_OPERATORS.get(operator):
+            used[res].update(k for k in operands if isinstance(k, NameObject))
+    return used
+
+
+def prune_resources(
+    resources: DictionaryObject, operations: list[Operation]
+) -> DictionaryObject:
+    "Copy of `resources` without the named resources that `operations` don't use"
+
+    used = used_resources(operations)
+    pruned = DictionaryObject()
+    for key, value in resources.items():
+        if key in RESOURCE_TYPES:
+            value = DictionaryObject(
+                (name, obj)
+                for name, obj in value.getObject().items()
+                if name in used[key]
+            )
+            if not value:
+                continue
+        pruned[NameObject(key)] = value
+    return pruned
+
+
+def merge_resources(
+    base: DictionaryObject, extra: DictionaryObject
+) -> tuple[DictionaryObject, dict[str, str]]:
+    """
+    Merges the resources of two pages, as PageObject.mergePage does. Returns the
+    merged resources and the renames to apply to `extra`'s content.
+    """
+
+    merged = DictionaryObject()
+    rename: dict[str, str] = {}
+    for res in RESOURCE_TYPES:
+        new, new_rename = PageObject._mergeResources(base, extra, res)  # type: ignore
+        if new:
+            merged[NameObject(res)] = new
+            rename.update(new_rename)
+
+    merged[NameObject("/ProcSet")] = ArrayObject(
+        frozenset(base.get("/ProcSet", ArrayObject()).getObject()).union(
+            frozenset(extra.get("/ProcSet", ArrayObject()).getObject())
+        )
+    )
+    return merged, rename
+
+
+class PageCropper:
+    """
+    Crops viewports out of the pages of one document onto blank pages, with an
+    optional header overlay. Gives the same result as extract_viewport followed by
+    mergePage(header), but each source page's content is parsed, and its resources
+    merged with the header's, only once however many crops are taken from it.
+    """
+
+    @dataclass
+    class _PreparedPage:
+        operations: list[Operation]  # draw the whole source page
+        header_operations: list[Operation]  # renamed to fit `resources`
+        resources: DictionaryObject
+        annots: list[typing.Any]
+
+    reader: PdfFileReader
+    header: typing.Optional[PageObject]
+    page_size: tuple[float, float]
+
+    def __init__(
+        self,
+        reader: PdfFileReader,
+        header: typing.Optional[PageObject] = None,
+        page_size: tuple[float, float] = (595.32, 842.04),
+    ):
+        self.reader = reader
+        self.header = header
+        self.page_size = page_size
+        self.lock = reader_lock(reader)
+
+        self._header_operations = (
+            [*clip_operations(header.trimBox), *parse_operations(header)]
+            if header
+            else []
+        )
+        self._pages: dict[int, PageCropper._PreparedPage] = {}
+
+    def crop(self, page_number: int, viewport: Viewport) -> PageObject:
+        with self.lock:
+            prepared = self._prepare(page_number)
+
+            new_page = PageObject.createBlankPage(  # type: ignore
+                width=self.page_size[0], height=self.page_size[1]
+            )
+
+            clip = clip_operations(
+                RectangleObject([0, viewport.y2, self.page_size[0], viewport.y1])
+            )
+            operations = [([], "q"), ([], "q"), *clip, *prepared.operations]
+            operations += [([], "Q"), ([], "Q")]
+            if self.header:
+                operations += [([], "q"), *prepared.header_operations, ([], "Q")]
+
+            content = ContentStream(ArrayObject(), self.reader)
+            content.operations = operations
+
+            new_page[NameObject("/Contents")] = content
+            new_page[NameObject("/Resources")] = DictionaryObject(
+                # copied per output page, as writers rewrite references in place
+                (key, copy.copy(value))
+                for key, value in prepared.resources.items()
+            )
+            new_page[NameObject("/Annots")] = ArrayObject(prepared.annots)
+            return new_page
+
+    def release(self) -> None:
+        "Drops every prepared page and parsed object, which are re-read as needed"
+
+        with self.lock:
+            self._pages.clear()
+            self.reader.resolvedObjects.clear()  # flattened pages only hold references
+
+    def _prepare(self, page_number: int) -> "PageCropper._PreparedPage":
+        if prepared := self._pages.get(page_number):
+            return prepared
+
+        page = self.reader.getPage(page_number)
+        operations = parse_operations(page)
+
+        # crops draw the whole page clipped, so keep whatever its content uses
+        resources, rename = (
+            prune_resources(page["/Resources"].getObject(), operations),
+            {},
+        )
+        if self.header:
+            resources, rename = merge_resources(
+                resources, self.header["/Resources"].getObject()
+            )
+
+        annots: list[typing.Any] = []
+        for source in (page, self.header) if self.header else (page,):
+            if isinstance(source.get("/Annots"), ArrayObject):
+                annots.extend(source["/Annots"])
+
+        prepared = self._pages[page_number] = PageCropper._PreparedPage(
+            operations,
+            rename_operations(self._header_operations, rename),
+            resources,
+            annots,
+        )
+        return prepared
+
+
+class FormXObjectCropper(PageCropper):
+    """
+    PageCropper that wraps each source page once as a Form XObject, and draws it
+    clipped on each output page, instead of copying the page's content into every
+    crop. Output pages only reference the form, so cropping costs about the same
+    for any page, and source content streams are copied without being re-encoded.
+    """
+
+    SOURCE_PAGE_NAME = NameObject("/SourcePage")
+
+    def __init__(
+        self,
+        reader: PdfFileReader,
+        header: typing.Optional[PageObject] = None,
+        page_size: tuple[float, float] = (595.32, 842.04),
+    ):
+        super().__init__(reader, header, page_size)
+
+        # Forms are indirect objects of this holder document. Writers copy objects
+        # from other documents once each, so a form shared by several pages of one
+        # output file is only written once.
+        self._forms = PdfFileWriter()
+
+    def release(self) -> None:
+        with self.lock:
+            super().release()
+            self._forms = PdfFileWriter()
+
+    def _prepare(self, page_number: int) -> "PageCropper._PreparedPage":
+        if prepared := self._pages.get(page_number):
+            return prepared
+
+        page = self.reader.getPage(page_number)
+        form: IndirectObject = self._forms._addObject(self.make_form(page))  # type: ignore
+
+        resources = DictionaryObject(
+            {
+                NameObject("/XObject"): DictionaryObject({self.SOURCE_PAGE_NAME: form}),
+                NameObject("/ProcSet"): page["/Resources"]
+                .getObject()
+                .get("/ProcSet", ArrayObject()),
+            }
+        )
+        rename = {}
+        if self.header:
+            resources, rename = merge_resources(
+                resources, self.header["/Resources"].getObject()
+            )
+
+        annots: list[typing.Any] = []
+        for source in (page, self.header) if self.header else (page,):
+            if isinstance(source.get("/Annots"), ArrayObject):
+                annots.extend(source["/Annots"])
+
+        prepared = self._pages[page_number] = PageCropper._PreparedPage(
+            [([self.SOURCE_PAGE_NAME], "Do")],
+            rename_operations(self._header_operations, rename),
+            resources,
+            annots,
+        )
+        return prepared
+
+    @staticmethod
+    def make_form(page: PageObject) -> StreamObject:
+        "Form XObject drawing the whole of `page`"
+
+        contents = page.getContents()
+        if isinstance(contents, StreamObject) and "/Filter" in contents:
+            # keep the source's compressed data as is
+            form = EncodedStreamObject()
+            form._data = contents._data  # type: ignore
+            for key in ("/Filter", "/DecodeParms"):
+                if key in contents:
+                    form[NameObject(key)] = contents.raw_get(key)
+        else:
+            form = DecodedStreamObject()
+            if isinstance(contents, StreamObject):
+                form.setData(contents.getData())
+            elif contents is not None:
+                form.setData(b"\n".join(k.getObject().getData() for k in contents))
+
+        form.update(
+            {
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Form"),
+                NameObject("/BBox"): RectangleObject(page.mediaBox),
+                NameObject("/Resources"): prune_resources(
+                    page["/Resources"].getObject(), parse_operations(page)
+                ),
+            }
+        )
+        return form
+
+
+class ResourceDeduplicator:
+    """
+    Makes the pages of one output file share a single copy of each distinct font
+    and XObject, comparing them by content. Source documents often hold a copy of
+    the same font per page, and the header brings its own.
+    """
+
+    SHARED_TYPES = ("/Font", "/XObject")
+
+    def __init__(self):
+        self._objects: dict[bytes, typing.Any] = {}  # by fingerprint
+        self._fingerprints: dict[tuple[int, int, int], bytes] = {}
+
+        # direct objects are made indirect objects of this holder document, so
+        # writers only write them once
+        self._holder = PdfFileWriter()
+
+    def dedupe(self, page: PageObject):
+        "Replaces the fonts and XObjects of `page` with ones seen before, in place"
+
+        resources = page["/Resources"]
+        for res in self.SHARED_TYPES:
+            if res not in resources:
+                continue
+            named = DictionaryObject(resources[res].getObject())
+            for name, obj in named.items():
+                key = self.fingerprint(obj)
+                if key not in self._objects:
+                    if not isinstance(obj, IndirectObject):
+                        obj = self._holder._addObject(obj)
+                    self._objects[key] = obj
+                named[name] = self._objects[key]
+            resources[NameObject(res)] = named
+
+    def fingerprint(self, obj: typing.Any) -> bytes:
+        "Hash of an object's content, following references"
+
+        if isinstance(obj, IndirectObject):
+            ref = (id(obj.pdf), obj.idnum, obj.generation)
+            if ref not in self._fingerprints:
+                self._fingerprints[ref] = b""  # in case of cycles
+                self._fingerprints[ref] = self.fingerprint(obj.getObject())
+            return self._fingerprints[ref]
+
+        digest = hashlib.sha256(type(obj).__name__.encode())
+        if isinstance(obj, StreamObject):
+            digest.update(obj._data)  # type: ignore
+        if isinstance(obj, dict):
+            for key in sorted(obj):
+                digest.update(key.encode())
+                digest.update(self.fingerprint(dict.__getitem__(obj, key)))
+        elif isinstance(obj, list):
+            for item in obj:
+                digest.update(self.fingerprint(item))
+        else:
+            digest.update(repr(obj).encode())
+        return digest.digest()
+
+
+# cropping backends, by name
+CROPPERS: dict[str, type[PageCropper]] = {
+    "merge": PageCropper,
+    "xobject": FormXObjectCropper,
+}
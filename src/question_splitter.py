@@ -1,11 +1,17 @@
-import functools
-import itertools
+import bisect
+import json
 import re
 import statistics
+import time
 import typing
 from dataclasses import dataclass
+from pathlib import Path
 
-from file_parser import MatchLTTextLine, PDFTextFinder
+import instrument
+from cache import SplitCache
+from file_parser import MatchLTTextLine, PDFTextFinder, load_or_build_index
+from memory import MemoryLimit
+from source import PDFInput
 
 
 @dataclass
@@ -29,127 +35,434 @@ class LabelMatchStore:
     header: list[MatchLTTextLine]
 
 
-T = typing.TypeVar("T")
+class LabelIndex:
+    """
+    The labels planning looks up for every question and page, indexed by page so
+    each lookup takes constant or logarithmic time. Labels are never modified.
+    """
 
+    def __init__(self) -> None:
+        self._section_ends: list[int] = []  # pages of "End of section" labels, sorted
+        self._continued: dict[int, MatchLTTextLine] = {}  # first on each page
 
-def iterate_with_next_item(
-    some_iterable: typing.Iterable[T],
-) -> typing.Iterable[tuple[T, typing.Optional[T]]]:
-    items, nexts = itertools.tee(some_iterable, 2)
-    nexts = itertools.chain(itertools.islice(nexts, 1, None), [None])
-    return zip(items, nexts)
+    def add(self, label: str, values: typing.Iterable[MatchLTTextLine]) -> None:
+        "Indexes more labels of a LabelMatchStore field"
 
+        if label == "end_of_section":
+            for value in values:
+                bisect.insort(self._section_ends, value.page)
+        elif label == "question_continued":
+            for value in values:
+                self._continued.setdefault(value.page, value)
 
-def _reduce_func(
-    acc: typing.Mapping[int, list[PageData]],
-    val: tuple[MatchLTTextLine, typing.Optional[MatchLTTextLine]],
-    labels: LabelMatchStore,
-    default_viewport: Viewport,
-    page_num: int,
-):
-    current_item: MatchLTTextLine = val[0]
+    def end_page(self, start: int, next_start: int) -> int:
+        """
+        The page after the last one of a question starting on page `start`, whose
+        next question starts on page `next_start`. An "End of section" between the
+        two ends the question on the page with the label.
+        """
 
-    # underscore to resolve typing issue
-    next_item_: typing.Optional[MatchLTTextLine] = val[1]
+        idx = bisect.bisect_left(self._section_ends, start)
+        if idx < len(self._section_ends) and self._section_ends[idx] < next_start:
+            return self._section_ends[idx] + 1
+        return next_start
 
-    end_of_file = not bool(next_item_)
+    def last_page(self, page_count: int) -> int:
+        "The page after the last one of the document's last question"
 
-    if end_of_file:
-        if labels.end_of_section:
-            next_item = labels.end_of_section[-1]
-            next_item.page += 1
-        else:
-            next_item = MatchLTTextLine(0, 0, 0, 0, page_num, result="ENDOFDOCUMENT")
-    else:
-        # check if End of Section is the next "item"
-        next_item = typing.cast(MatchLTTextLine, next_item_)
+        return self._section_ends[-1] + 1 if self._section_ends else page_count
 
-        label = filter(
-            lambda x: current_item.page <= x.page and next_item.page > x.page,  # type: ignore
-            labels.end_of_section,
-        )
+    def viewport(self, page: int, default_viewport: Viewport) -> Viewport:
+        "Viewport of a page a question continues onto"
 
-        if value := next(label, False):
-            value = typing.cast(MatchLTTextLine, value)
+        label = self._continued.get(page, default_viewport)
+        return Viewport(label.y1, default_viewport.y2)
 
-            value.page += 1
-            next_item = value
 
-    question_number = int(current_item.result)
+def question_pages(
+    start: MatchLTTextLine, end_page: int, viewport: Viewport, index: LabelIndex
+) -> list[PageData]:
+    "Pages of a question from its label up to (not including) `end_page`"
 
-    def _determine_viewport(page: int) -> Viewport:
-        label = filter(lambda x: x.page == page, labels.question_continued)  # type: ignore
-        page_top = next(label, default_viewport).y1
+    return [PageData(start.page, Viewport(start.y1, viewport.y2))] + [
+        PageData(k, index.viewport(k, viewport))
+        for k in range(start.page + 1, end_page)
+    ]
 
-        return Viewport(page_top, default_viewport.y2)
 
-    if question_number in acc.keys():
-        print(
-            f"Question {question_number} at page {current_item.page} already exists, re-adding..."
-        )
-        print(next_item)
-        acc[question_number].extend(
-            [
-                PageData(
-                    current_item.page,
-                    Viewport(current_item.y1, default_viewport.y2),
-                )
-            ]
-            + [
-                PageData(k, _determine_viewport(k))
-                for k in range(current_item.page + 1, next_item.page)
-            ]
+def add_question(
+    plan: dict[int, list[PageData]], start: MatchLTTextLine, pages: list[PageData]
+) -> int:
+    "Adds a question's pages to `plan`, after any earlier ones with its number"
+
+    question_number = int(start.result)
+    if question_number in plan:
+        instrument.emit(
+            "message",
+            question=question_number,
+            page=start.page,
+            message=f"Question {question_number} at page {start.page} already exists, re-adding...",
         )
-        return acc
+        plan[question_number] = plan[question_number] + pages
+    else:
+        plan[question_number] = pages
+    return question_number
 
-    pages = [
-        PageData(current_item.page, Viewport(current_item.y1, default_viewport.y2))
-    ] + [
-        PageData(k, _determine_viewport(k))
-        for k in range(current_item.page + 1, next_item.page)
-    ]
 
-    return {**acc, question_number: pages}
+def emit_planned(question: int, pages: list[PageData]) -> None:
+    "Reports a planned question, so it counts before, or without, being written"
 
+    instrument.emit(
+        "question",
+        stage="plan",
+        question=question,
+        page=pages[0].page if pages else None,
+    )
 
-def split_question(file: str) -> typing.Mapping[int, list[PageData]]:
-    "Split a file into its component questions"
 
-    SEARCH_FOR_QUESTION_REGEX = re.compile(r"Question (\d+)(?!\d*.*con)", re.IGNORECASE)
-    #                            group question number ^ |  ^ negative lookahead for "continued..."
-    SEARCH_FOR_QUESTION_CONTINUED = re.compile(r"Question (\d+.*con)", re.IGNORECASE)
-    SEARCH_FOR_NEXT_PAGE_REGEX = re.compile(r"See (next) page", re.IGNORECASE)
-    SEARCH_FOR_END_OF_SECTION = re.compile(
-        r"End (of)(?! this booklet)(?! sol)", re.IGNORECASE
-    )
-    SEARCH_FOR_HEADER = re.compile(r"(Specialist)", re.IGNORECASE)
-
-    f = PDFTextFinder(file)
-    labels = LabelMatchStore(
-        f.find_matches(SEARCH_FOR_QUESTION_REGEX),
-        f.find_matches(SEARCH_FOR_NEXT_PAGE_REGEX),
-        f.find_matches(SEARCH_FOR_END_OF_SECTION),
-        f.find_matches(SEARCH_FOR_QUESTION_CONTINUED),
-        f.find_matches(SEARCH_FOR_HEADER),
-    )
-    f.close()
+def default_viewport(labels: LabelMatchStore) -> Viewport:
+    "Viewport of the pages a question continues onto, unless they say otherwise"
 
     TOP_OF_PAGE = max(k.y2 for k in labels.question)
     BOTTOM_OF_PAGE = min(k.y2 for k in labels.next_page) if labels.next_page else 0
     HEADER_START = statistics.mode(k.y1 for k in labels.header)
 
-    DEFAULT_VIEWPORT = Viewport(min(TOP_OF_PAGE + 20, HEADER_START), BOTTOM_OF_PAGE)
     # add 20 to the default viewport in case an equation sticks out above the line
+    return Viewport(min(TOP_OF_PAGE + 20, HEADER_START), BOTTOM_OF_PAGE)
 
-    values = functools.reduce(
-        functools.partial(
-            _reduce_func,
-            labels=labels,
-            default_viewport=DEFAULT_VIEWPORT,
-            page_num=len(f.pages),
-        ),
-        iterate_with_next_item(labels.question),
-        typing.cast(typing.Mapping[int, list[PageData]], {}),
-    )
 
-    return values
+SEARCH_FOR_QUESTION_REGEX = re.compile(r"Question (\d+)(?!\d*.*con)", re.IGNORECASE)
+#                            group question number ^ |  ^ negative lookahead for "continued..."
+SEARCH_FOR_QUESTION_CONTINUED = re.compile(r"Question (\d+.*con)", re.IGNORECASE)
+SEARCH_FOR_NEXT_PAGE_REGEX = re.compile(r"See (next) page", re.IGNORECASE)
+SEARCH_FOR_END_OF_SECTION = re.compile(
+    r"End (of)(?! this booklet)(?! sol)", re.IGNORECASE
+)
+SEARCH_FOR_HEADER = re.compile(r"(Specialist)", re.IGNORECASE)
+
+# regexes searched for, keyed by their LabelMatchStore field
+SEARCH_PATTERNS: dict[str, typing.Pattern[str]] = {
+    "question": SEARCH_FOR_QUESTION_REGEX,
+    "next_page": SEARCH_FOR_NEXT_PAGE_REGEX,
+    "end_of_section": SEARCH_FOR_END_OF_SECTION,
+    "question_continued": SEARCH_FOR_QUESTION_CONTINUED,
+    "header": SEARCH_FOR_HEADER,
+}
+
+
+@dataclass
+class SplitResult:
+    "Everything detected in a file, as stored in the split cache"
+
+    labels: LabelMatchStore
+    page_count: int
+    plan: typing.Mapping[int, list[PageData]]
+
+
+@dataclass
+class QuestionPlan:
+    """
+    The pages and viewports of every question in a PDF. Saved as JSON, so questions
+    can be extracted later without detecting them again.
+    """
+
+    VERSION: typing.ClassVar[int] = 1
+
+    file: str  # absolute path of the PDF when it was planned
+    sha256: str  # hash of the planned PDF
+    questions: typing.Mapping[int, list[PageData]]
+
+    def save(self, path: typing.Union[str, Path]) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": self.VERSION,
+                    "file": self.file,
+                    "sha256": self.sha256,
+                    "questions": {
+                        str(question): [
+                            [k.page, k.viewport.y1, k.viewport.y2] for k in pages
+                        ]
+                        for question, pages in self.questions.items()
+                    },
+                },
+                f,
+                separators=(",", ":"),
+            )
+
+    @classmethod
+    def load(cls, path: typing.Union[str, Path]) -> "QuestionPlan":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+
+        if data.get("version") != cls.VERSION:
+            raise ValueError(f"Unsupported plan version in {path}")
+        return cls(
+            data["file"],
+            data["sha256"],
+            {
+                int(question): [
+                    PageData(page, Viewport(y1, y2)) for page, y1, y2 in pages
+                ]
+                for question, pages in data["questions"].items()
+            },
+        )
+
+    @staticmethod
+    def sidecar_path(filename: str) -> Path:
+        return Path(f"{filename}.plan.json")
+
+
+def detect_labels(
+    file: PDFInput,
+    workers: int = 1,
+    use_index: bool = False,
+    engine: str = "layout",
+    memory_limit: typing.Optional[MemoryLimit] = None,
+) -> tuple[LabelMatchStore, int]:
+    """
+    Finds every label in a file. Returns the labels and the file's page count.
+
+    With `use_index`, labels are searched in the file's sidecar line index, which is
+    built on first use. If an engine other than "layout" finds no questions at all,
+    the file is searched again with the full layout engine.
+    """
+
+    if use_index:
+        index = load_or_build_index(
+            file, workers=workers, engine=engine, memory_limit=memory_limit
+        )
+        labels = LabelMatchStore(**index.find_all_matches(SEARCH_PATTERNS))
+        page_count = index.page_count
+    else:
+        f = PDFTextFinder(
+            file, workers=workers, engine=engine, memory_limit=memory_limit
+        )
+        try:
+            labels = LabelMatchStore(**f.find_all_matches(SEARCH_PATTERNS))
+        finally:
+            f.close()
+        page_count = f.page_count
+
+    if not labels.question and engine != "layout":
+        instrument.emit(
+            "message",
+            message=f"No questions found with the {engine} engine, retrying with layout",
+        )
+        return detect_labels(
+            file, workers=workers, use_index=use_index, memory_limit=memory_limit
+        )
+
+    return labels, page_count
+
+
+def plan_questions(
+    labels: LabelMatchStore, page_count: int
+) -> typing.Mapping[int, list[PageData]]:
+    "Works out the pages and viewports of every question from its labels"
+
+    index = LabelIndex()
+    for label in ("end_of_section", "question_continued"):
+        index.add(label, getattr(labels, label))
+    viewport = default_viewport(labels)
+
+    plan: dict[int, list[PageData]] = {}
+    for current, next_item in zip(labels.question, labels.question[1:]):
+        end_page = index.end_page(current.page, next_item.page)
+        add_question(plan, current, question_pages(current, end_page, viewport, index))
+    if labels.question:
+        last = labels.question[-1]
+        end_page = index.last_page(page_count)
+        add_question(plan, last, question_pages(last, end_page, viewport, index))
+
+    return plan
+
+
+class StreamingPlanner:
+    """
+    Builds the same plan as plan_questions, from labels fed in one page at a time.
+
+    A question is ready once the label ending it (the next "Question N", or an
+    "End of section" before it) has been seen. But the default viewport, which
+    every question's page bottoms use, depends on labels across the whole
+    document. Ready questions are held back until the viewport found so far has
+    stayed the same for `settle_pages` pages, and are then emitted with it. `finish`
+    re-emits any question whose pages still changed by the end of the document,
+    which only happens if a later page is laid out unlike the earlier ones.
+    """
+
+    labels: LabelMatchStore
+    plan: dict[int, list[PageData]]
+
+    def __init__(self, settle_pages: int = 2) -> None:
+        self.labels = LabelMatchStore([], [], [], [], [])
+        self.plan = {}
+        self.settle_pages = settle_pages
+
+        self._index = LabelIndex()
+        self._current: typing.Optional[MatchLTTextLine] = None
+        # (question start, end page) of every finished question, in order
+        self._chunks: list[tuple[MatchLTTextLine, int]] = []
+        self._emitted = 0  # number of chunks emitted so far
+        self._viewport: typing.Optional[Viewport] = None
+        self._unchanged_pages = 0  # pages added since the viewport last changed
+
+    def add_page(
+        self, matches: typing.Mapping[str, list[MatchLTTextLine]]
+    ) -> typing.Iterator[tuple[int, list[PageData]]]:
+        "Adds the labels of the next page, yielding every question it completes"
+
+        # everything but the questions first: a question ending on this page only
+        # needs labels from earlier pages, but a later one may need this page's
+        for label, values in matches.items():
+            if label != "question":
+                getattr(self.labels, label).extend(values)
+                self._index.add(label, values)
+
+        for question in matches.get("question", []):
+            self.labels.question.append(question)
+            if self._current:
+                end_page = self._index.end_page(self._current.page, question.page)
+                self._chunks.append((self._current, end_page))
+            self._current = question
+
+        viewport = self._provisional_viewport()
+        if viewport != self._viewport:
+            self._viewport = viewport
+            self._unchanged_pages = 0
+        else:
+            self._unchanged_pages += 1
+
+        if self._unchanged_pages >= self.settle_pages:
+            yield from self._emit(viewport)
+
+    def finish(self, page_count: int) -> typing.Iterator[tuple[int, list[PageData]]]:
+        "Completes the last question, and re-emits any that have changed"
+
+        if self._current:
+            self._chunks.append((self._current, self._index.last_page(page_count)))
+            self._current = None
+
+        previous = self.plan
+        self.plan = {}
+        self._emitted = 0
+
+        for _ in self._emit(default_viewport(self.labels)):
+            pass
+
+        for question, pages in self.plan.items():
+            # only questions not emitted before, or whose pages have changed
+            if previous.get(question) != pages:
+                yield question, pages
+
+    def _emit(
+        self, viewport: typing.Optional[Viewport]
+    ) -> typing.Iterator[tuple[int, list[PageData]]]:
+        if not viewport:
+            return
+
+        while self._emitted < len(self._chunks):
+            start, end_page = self._chunks[self._emitted]
+            self._emitted += 1
+
+            pages = question_pages(start, end_page, viewport, self._index)
+            question_number = add_question(self.plan, start, pages)
+            yield question_number, self.plan[question_number]
+
+    def _provisional_viewport(self) -> typing.Optional[Viewport]:
+        if not (self.labels.question and self.labels.header):
+            return None
+        return default_viewport(self.labels)
+
+
+def iter_split_question(
+    file: PDFInput,
+    cache: typing.Optional[SplitCache] = None,
+    engine: str = "layout",
+    memory_limit: typing.Optional[MemoryLimit] = None,
+) -> typing.Iterator[tuple[int, list[PageData]]]:
+    """
+    Streaming split_question. Yields (question, pages) once each question's
+    boundaries are known and the page layout has settled (see StreamingPlanner),
+    scanning the file one page at a time. A question may be yielded again, with
+    updated pages, once the whole file has been scanned.
+    """
+
+    key = cache.key(file, SEARCH_PATTERNS, engine) if cache else ""
+    if cache and (cached := cache.get(key)):
+        for item in typing.cast(SplitResult, cached).plan.items():
+            emit_planned(*item)
+            yield item
+        return
+
+    planner = StreamingPlanner()
+    f = PDFTextFinder(file, engine=engine, memory_limit=memory_limit)
+    try:
+        # detection and planning interleave here; only the time spent in this
+        # generator counts, not that of whoever consumes the questions
+        detect = 0.0
+        start = time.perf_counter()
+        for _, matches in f.iter_page_matches(SEARCH_PATTERNS):
+            for question in planner.add_page(matches):
+                detect += time.perf_counter() - start
+                emit_planned(*question)
+                yield question
+                start = time.perf_counter()
+        detect += time.perf_counter() - start
+    finally:
+        f.close()
+    instrument.emit("stage", stage="detect", duration=detect)
+
+    if not planner.labels.question and engine != "layout":
+        instrument.emit(
+            "message",
+            message=f"No questions found with the {engine} engine, retrying with layout",
+        )
+        yield from iter_split_question(file, cache=cache, memory_limit=memory_limit)
+        return
+
+    with instrument.stage("plan"):
+        finished = list(planner.finish(f.page_count))
+    for item in finished:
+        emit_planned(*item)
+        yield item
+
+    if cache:
+        cache.put(key, SplitResult(planner.labels, f.page_count, planner.plan))
+
+
+def split_question(
+    file: PDFInput,
+    workers: int = 1,
+    cache: typing.Optional[SplitCache] = None,
+    use_index: bool = False,
+    engine: str = "layout",
+    memory_limit: typing.Optional[MemoryLimit] = None,
+) -> typing.Mapping[int, list[PageData]]:
+    "Split a file into its component questions"
+
+    key = cache.key(file, SEARCH_PATTERNS, engine) if cache else ""
+    if cache and (cached := cache.get(key)):
+        plan = typing.cast(SplitResult, cached).plan
+        for item in plan.items():
+            emit_planned(*item)
+        return plan
+
+    with instrument.stage("detect"):
+        labels, page_count = detect_labels(
+            file,
+            workers=workers,
+            use_index=use_index,
+            engine=engine,
+            memory_limit=memory_limit,
+        )
+
+    with instrument.stage("plan"):
+        plan = plan_questions(labels, page_count)
+    for item in plan.items():
+        emit_planned(*item)
+
+    if cache:
+        cache.put(key, SplitResult(labels, page_count, plan))
+
+    return plan
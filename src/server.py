@@ -0,0 +1,195 @@
+import collections
+import io
+import json
+import os
+import threading
+import typing
+import urllib.parse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import main
+import pdf_splitter
+import question_splitter
+from cache import SplitCache
+from source import SourcePDF
+
+
+class Document:
+    "An open, split PDF, ready to crop any of its questions"
+
+    source: SourcePDF
+    plan: typing.Mapping[int, list[question_splitter.PageData]]
+    cropper: pdf_splitter.PageCropper
+    stamp: tuple[int, int]  # (mtime, size) of the file when it was opened
+
+    def __init__(
+        self,
+        filename: str,
+        header: typing.Optional[str] = None,
+        crop_backend: str = "merge",
+        engine: str = "layout",
+        cache: typing.Optional[SplitCache] = None,
+    ):
+        self.stamp = self.file_stamp(filename)
+        self.source = SourcePDF(filename)
+        try:
+            self.plan = question_splitter.split_question(
+                self.source, cache=cache, engine=engine
+            )
+            text_page = pdf_splitter.create_textbox_in_page(
+                header or Path(filename).stem, location=(55, 790)
+            )
+            self.cropper = pdf_splitter.CROPPERS[crop_backend](
+                self.source.reader, text_page
+            )
+        except BaseException:
+            self.source.close()
+            raise
+
+        # PyPDF2 readers aren't thread safe
+        self.lock = threading.Lock()
+
+    def question_pdf(self, question: int) -> bytes:
+        "One question as a PDF file, built in memory"
+
+        with self.lock:
+            output_pdf = main.build_question(
+                self.cropper, question, self.plan[question]
+            )
+            buffer = io.BytesIO()
+            output_pdf.write(buffer)
+        return buffer.getvalue()
+
+    @staticmethod
+    def file_stamp(filename: str) -> tuple[int, int]:
+        stat = os.stat(filename)
+        return stat.st_mtime_ns, stat.st_size
+
+
+class DocumentCache:
+    """
+    The most recently used documents, kept open and split between requests. A
+    document is opened again if its file has changed since.
+    """
+
+    def __init__(
+        self,
+        max_documents: int = 8,
+        **options: typing.Any,
+    ):
+        self.max_documents = max_documents
+        self.options = options  # passed on to every Document
+
+        self._documents: collections.OrderedDict[str, Document] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, filename: str) -> Document:
+        with self._lock:
+            document = self._documents.get(filename)
+            if document and document.stamp == Document.file_stamp(filename):
+                self._documents.move_to_end(filename)
+                return document
+
+        # split outside the lock, so other documents can still be served meanwhile
+        document = Document(filename, **self.options)
+
+        # evicted documents aren't closed, as requests may still be using them; their
+        # files are unmapped once the last one finishes
+        with self._lock:
+            self._documents[filename] = document
+            self._documents.move_to_end(filename)
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+        return document
+
+    def clear(self) -> None:
+        with self._lock:
+            self._documents.clear()
+
+
+class QuestionRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /question?file=PATH&question=N returns the PDF of one question.
+    GET /plan?file=PATH returns the pages of every question, as JSON.
+
+    PATH is relative to the server's root folder, and can't leave it.
+    """
+
+    server: "QuestionServer"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path not in ("/question", "/plan"):
+            return self.send_error(HTTPStatus.NOT_FOUND)
+        if "file" not in query:
+            return self.send_error(HTTPStatus.BAD_REQUEST, "Missing file")
+
+        filename = self.server.resolve(query["file"][0])
+        if not filename:
+            return self.send_error(HTTPStatus.NOT_FOUND, "No such file")
+
+        try:
+            document = self.server.documents.get(filename)
+
+            if url.path == "/plan":
+                body = json.dumps(
+                    {
+                        question: [
+                            [k.page, k.viewport.y1, k.viewport.y2] for k in pages
+                        ]
+                        for question, pages in document.plan.items()
+                    }
+                ).encode()
+                return self.send_body(body, "application/json")
+
+            try:
+                question = int(query["question"][0])
+            except (KeyError, ValueError):
+                return self.send_error(HTTPStatus.BAD_REQUEST, "Missing question")
+            if question not in document.plan:
+                return self.send_error(HTTPStatus.NOT_FOUND, "No such question")
+
+            self.send_body(document.question_pdf(question), "application/pdf")
+        except Exception as e:
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, repr(e))
+
+    def send_body(self, body: bytes, content_type: str):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class QuestionServer(ThreadingHTTPServer):
+    "Serves single questions of the PDFs under `root`, keeping recent ones split"
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        root: typing.Union[str, Path],
+        documents: DocumentCache,
+    ):
+        super().__init__(address, QuestionRequestHandler)
+        self.root = Path(root).resolve()
+        self.documents = documents
+
+    def resolve(self, filename: str) -> typing.Optional[str]:
+        "Absolute path of a requested file, or None if it's outside the root"
+
+        path = (self.root / filename).resolve()
+        if not path.is_relative_to(self.root) or not path.is_file():
+            return None
+        return str(path)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.documents.clear()
@@ -0,0 +1,110 @@
+import functools
+import hashlib
+import io
+import mmap
+import typing
+
+if typing.TYPE_CHECKING:
+    import PyPDF2
+
+
+class BufferView(io.BufferedIOBase):
+    "Read-only file object over a shared buffer, with its own position"
+
+    def __init__(self, buffer: memoryview, name: str = ""):
+        self._buffer = buffer
+        self._position = 0
+        self.name = name
+        self.mode = "rb"
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._buffer)
+        self._position = max(0, offset)
+        return self._position
+
+    def read(self, size: typing.Optional[int] = -1) -> bytes:
+        start = min(self._position, len(self._buffer))
+        end = len(self._buffer) if size is None or size < 0 else start + size
+        data = self._buffer[start:end].tobytes()
+        self._position = start + len(data)
+        return data
+
+    read1 = read
+
+    def readline(self, size: typing.Optional[int] = -1) -> bytes:
+        start = min(self._position, len(self._buffer))
+        end = self._buffer.obj.find(b"\n", start) + 1 or len(self._buffer)  # type: ignore
+        if size is not None and size >= 0:
+            end = min(end, start + size)
+        return self.read(end - start)
+
+
+class SourcePDF:
+    """
+    An input PDF, read from disk once into a shared read-only memory map.
+
+    pdfminer (for detection) and PyPDF2 (for cropping) each parse the file through
+    their own view of the map, so it is never read or copied twice. They still
+    build separate object graphs, as neither library can use the other's.
+    """
+
+    filename: str
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            try:
+                self._map: typing.Union[mmap.mmap, bytes] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            except ValueError:  # empty files can't be mapped
+                self._map = b""
+        self._buffer = memoryview(self._map)
+
+    def view(self) -> BufferView:
+        "A new file object over the file's contents"
+
+        return BufferView(self._buffer, self.filename)
+
+    @functools.cached_property
+    def sha256(self) -> str:
+        return hashlib.sha256(self._buffer).hexdigest()
+
+    @functools.cached_property
+    def reader(self) -> "PyPDF2.PdfFileReader":
+        "PyPDF2 reader of the file, which loads objects as they're used"
+
+        import PyPDF2  # only needed for cropping, and slow to import
+
+        return PyPDF2.PdfFileReader(self.view())
+
+    def close(self) -> None:
+        self._buffer.release()
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def __enter__(self) -> "SourcePDF":
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        self.close()
+
+
+# a filename, or an already opened file
+PDFInput = typing.Union[str, SourcePDF]
+
+
+def filename_of(file: PDFInput) -> str:
+    return file.filename if isinstance(file, SourcePDF) else file
@@ -0,0 +1,254 @@
+import concurrent.futures
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import time
+import typing
+from pathlib import Path
+
+import batch
+from atomic import write_atomically
+
+# inotify(7) constants
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len; then the name
+
+
+def is_watched_file(path: str) -> bool:
+    name = os.path.basename(path)
+    return name.lower().endswith(".pdf") and not name.startswith(".")
+
+
+def file_stamp(path: str) -> typing.Optional[tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class InotifyWatcher:
+    "Reports files created or written to in some directories, with Linux's inotify"
+
+    def __init__(self, directories: typing.Iterable[str]):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.directories: dict[int, str] = {}  # by watch descriptor
+        for directory in directories:
+            wd = libc.inotify_add_watch(
+                self.fd,
+                os.fsencode(directory),
+                IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE,
+            )
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"Can't watch {directory}")
+            self.directories[wd] = directory
+
+    def changes(self, timeout: float) -> set[str]:
+        "Paths of the files that changed, waiting up to `timeout` seconds for any"
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if name and wd in self.directories:
+                changed.add(os.path.join(self.directories[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    "Reports files created or written to in some directories, by listing them"
+
+    def __init__(self, directories: typing.Iterable[str], interval: float = 2.0):
+        self.directories = list(directories)
+        self.interval = interval
+        self._stamps = self._scan()  # files already there aren't changes
+        self._next_scan = time.monotonic() + interval
+
+    def changes(self, timeout: float) -> set[str]:
+        "Paths of the files that changed, waiting up to `timeout` seconds for any"
+
+        wait = self._next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0.0, wait))
+        self._next_scan = time.monotonic() + self.interval
+
+        stamps = self._scan()
+        changed = {k for k, v in stamps.items() if self._stamps.get(k) != v}
+        self._stamps = stamps
+        return changed
+
+    def close(self) -> None:
+        pass
+
+    def _scan(self) -> dict[str, typing.Optional[tuple[int, int]]]:
+        stamps = {}
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        stamps[entry.path] = file_stamp(entry.path)
+            except OSError:
+                continue
+        return stamps
+
+
+Watcher = typing.Union[InotifyWatcher, PollingWatcher]
+
+
+def make_watcher(directories: list[str], polling: bool = False) -> Watcher:
+    "An inotify watcher where available, or else a polling one"
+
+    if not polling:
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError, TypeError):
+            pass  # not Linux, or out of watches
+    return PollingWatcher(directories)
+
+
+class Debouncer:
+    """
+    Holds back changed files until they have stopped changing for `settle`
+    seconds, so files still being copied in aren't processed half written.
+    """
+
+    def __init__(self, settle: float = 2.0):
+        self.settle = settle
+        self._pending: dict[str, tuple[typing.Optional[tuple[int, int]], float]] = {}
+
+    def touch(self, path: str) -> None:
+        self._pending[path] = (file_stamp(path), time.monotonic())
+
+    def ready(self) -> list[str]:
+        "Files that have settled, which are no longer held"
+
+        now = time.monotonic()
+        settled = []
+        for path, (stamp, since) in list(self._pending.items()):
+            current = file_stamp(path)
+            if current is None:
+                del self._pending[path]  # deleted or moved away
+            elif current != stamp:
+                self._pending[path] = (current, now)
+            elif now - since >= self.settle:
+                del self._pending[path]
+                settled.append(path)
+        return settled
+
+
+class PersistentQueue:
+    """
+    Files waiting to be processed, or being processed, saved to disk whenever it
+    changes. A file only leaves the queue once it has been processed, so work
+    queued before a restart is picked up again.
+    """
+
+    def __init__(self, path: typing.Union[str, Path]):
+        self.path = Path(path)
+        self.waiting: list[str] = []
+        self.running: set[str] = set()
+
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.waiting = list(dict.fromkeys(json.load(f)))
+        except (OSError, ValueError):
+            pass
+
+    def __len__(self) -> int:
+        return len(self.waiting) + len(self.running)
+
+    def push(self, path: str) -> None:
+        if path not in self.waiting:
+            self.waiting.append(path)
+            self.save()
+
+    def take(self) -> typing.Optional[str]:
+        "The next waiting file, skipping any already running"
+
+        for path in self.waiting:
+            if path not in self.running:
+                self.waiting.remove(path)
+                self.running.add(path)
+                return path
+        return None
+
+    def done(self, path: str) -> None:
+        self.running.discard(path)
+        self.save()
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        write_atomically(self.path, json.dumps([*self.running, *self.waiting]).encode())
+
+
+def watch(
+    directories: list[str],
+    callback: typing.Callable[[str], typing.Any],
+    queue: PersistentQueue,
+    on_result: typing.Callable[[batch.FileResult], None],
+    jobs: typing.Optional[int] = None,
+    settle: float = 2.0,
+    polling: bool = False,
+) -> None:
+    """
+    Runs `callback` on every PDF written into `directories` once it has settled,
+    across a process pool, until interrupted. Only a couple of files per worker
+    are submitted at once; the rest wait in `queue`.
+
+    `callback` must be picklable, as for batch.process_files.
+    """
+
+    jobs = jobs or os.cpu_count() or 1
+    watcher = make_watcher(directories, polling)
+    debouncer = Debouncer(settle)
+
+    try:
+        with batch.worker_pool(jobs) as executor:
+            running: dict[concurrent.futures.Future[batch.FileResult], str] = {}
+            while True:
+                for path in watcher.changes(timeout=0.5):
+                    if is_watched_file(path):
+                        debouncer.touch(path)
+                for path in debouncer.ready():
+                    queue.push(path)
+
+                while len(running) < jobs * 2 and (path := queue.take()):
+                    running[executor.submit(batch.run_one, callback, path)] = path
+
+                for future in [k for k in running if k.done()]:
+                    queue.done(running.pop(future))
+                    on_result(future.result())
+    finally:
+        watcher.close()
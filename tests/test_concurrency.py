@@ -0,0 +1,99 @@
+import os
+import sys
+
+import PyPDF2
+import pytest
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    NameObject,
+    TextStringObject,
+)
+
+import benchmark
+import main
+from benchmark import ExamSpec
+
+
+def embed_fonts(source, path):
+    """
+    Rewrites `source` so every page has fonts, font files and annotations of its
+    own, which nothing else has read when its questions are cropped
+    """
+
+    with open(source, "rb") as f:
+        reader = PyPDF2.PdfFileReader(f)
+        writer = PyPDF2.PdfFileWriter()
+        for page in reader.pages:
+            fonts = DictionaryObject()
+            for name, font in page["/Resources"]["/Font"].items():
+                font_file = DecodedStreamObject()
+                font_file.setData(os.urandom(4096))
+                font = DictionaryObject(font.getObject())
+                font[NameObject("/FontDescriptor")] = writer._addObject(
+                    DictionaryObject(
+                        {
+                            NameObject("/Type"): NameObject("/FontDescriptor"),
+                            NameObject("/FontFile2"): writer._addObject(font_file),
+                        }
+                    )
+                )
+                fonts[name] = writer._addObject(font)
+
+            resources = DictionaryObject(page["/Resources"])
+            resources[NameObject("/Font")] = fonts
+            page[NameObject("/Resources")] = resources
+            page[NameObject("/Annots")] = ArrayObject(
+                writer._addObject(
+                    DictionaryObject(
+                        {
+                            NameObject("/Type"): NameObject("/Annot"),
+                            NameObject("/Subtype"): NameObject("/Text"),
+                            NameObject("/Contents"): TextStringObject("x" * 2048),
+                        }
+                    )
+                )
+                for _ in range(10)
+            )
+            writer.addPage(page)
+
+        with open(path, "wb") as out:
+            writer.write(out)
+
+
+@pytest.fixture
+def fast_switching():
+    # switch threads as often as possible, so unguarded reads of the input overlap
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+@pytest.mark.parametrize("crop_backend", ["merge", "xobject"])
+def test_cropping_while_writing_shares_the_reader(
+    tmp_path, fast_switching, crop_backend
+):
+    # cropping and deduping the fonts of a question reads the input, while
+    # QuestionWriter threads serialize earlier questions from the same reader
+    plain, path = tmp_path / "plain.pdf", tmp_path / "exam.pdf"
+    benchmark.generate_exam(ExamSpec(pages=40), plain)
+    embed_fonts(plain, path)
+
+    for _ in range(2):
+        main.extract_questions_from_file(
+            str(path),
+            output=str(tmp_path / "questions"),
+            engine="fast",
+            crop_backend=crop_backend,
+            force=True,
+        )
+
+    questions = list((tmp_path / "questions").glob("*.pdf"))
+    assert len(questions) == 54
+    for question in questions:
+        with open(question, "rb") as f:
+            reader = PyPDF2.PdfFileReader(f)
+            for page in reader.pages:
+                assert page["/Resources"]["/Font"]
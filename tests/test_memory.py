@@ -0,0 +1,86 @@
+import concurrent.futures
+import multiprocessing
+
+import PyPDF2
+import pytest
+
+import benchmark
+import main
+import pdf_splitter
+from benchmark import ExamSpec, PeakMemory
+from file_parser import PDFTextFinder
+from memory import resident_memory
+from question_splitter import Viewport
+
+# ceiling given to the splitter, and the most the process may ever use; the
+# difference covers the page or question read between two checks of the ceiling.
+# Without a ceiling, the compilation below takes about 74 MB.
+MAX_MEMORY_MB = 48
+RSS_BUDGET_MB = 56
+
+
+def split_with_ceiling(path: str, output: str) -> int:
+    "Splits `path` under MAX_MEMORY_MB, returning the peak RSS of this process"
+
+    with PeakMemory() as memory:
+        main.extract_questions_from_file(
+            path, output=output, engine="fast", max_memory=MAX_MEMORY_MB
+        )
+        return max(memory.peak or 0, resident_memory() or 0)
+
+
+@pytest.mark.skipif(resident_memory() is None, reason="RSS can't be measured here")
+def test_compilation_stays_under_rss_budget(tmp_path):
+    path = tmp_path / "compilation.pdf"
+    benchmark.generate_exam(ExamSpec(pages=500), path)
+
+    # in a new process, as whatever earlier tests left on the heap counts towards
+    # the RSS of this one
+    spawn = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=spawn) as executor:
+        peak = executor.submit(
+            split_with_ceiling, str(path), str(tmp_path / "questions")
+        ).result()
+
+    assert len(list((tmp_path / "questions").glob("*.pdf"))) == 668
+    assert peak < RSS_BUDGET_MB * 1024 * 1024
+
+
+def test_text_finder_release_clears_pdfminer_caches(tmp_path):
+    # release() clears private pdfminer caches, which a new version could rename
+    path = tmp_path / "exam.pdf"
+    benchmark.generate_exam(ExamSpec(pages=3), path)
+
+    finder = PDFTextFinder(str(path))
+    try:
+        finder.collect_all_lines()
+        assert finder.document._cached_objs
+        assert finder.interpreter.rsrcmgr._cached_fonts
+
+        finder.release()
+        assert not finder.document._cached_objs
+        assert not finder.document._parsed_objs
+        assert not finder.interpreter.rsrcmgr._cached_fonts
+    finally:
+        finder.close()
+
+
+@pytest.mark.parametrize("crop_backend", list(pdf_splitter.CROPPERS))
+def test_cropper_release_clears_pypdf2_cache(tmp_path, crop_backend):
+    # release() clears the private object cache of PyPDF2's reader
+    path = tmp_path / "exam.pdf"
+    benchmark.generate_exam(ExamSpec(pages=3), path)
+
+    with open(path, "rb") as f:
+        reader = PyPDF2.PdfFileReader(f)
+        text_page = pdf_splitter.create_textbox_in_page("Test", location=(55, 790))
+        cropper = pdf_splitter.CROPPERS[crop_backend](reader, text_page)
+
+        cropper.crop(0, Viewport(700, 50))
+        assert reader.resolvedObjects
+
+        cropper.release()
+        assert not reader.resolvedObjects
+
+        # pages are read again after a release
+        assert cropper.crop(1, Viewport(700, 50))